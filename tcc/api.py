@@ -1,5 +1,18 @@
+import operator
+from datetime import datetime
+
+from django.contrib.contenttypes.models import ContentType
 from django.core.exceptions import ObjectDoesNotExist
-from tcc.models import Comment, SpamReport
+from django.db.models import Count, Max, Q
+
+from tcc import dispatch
+from tcc import identity
+from tcc import readmarkers
+from tcc import signals
+from tcc import utils
+from tcc import settings as tcc_settings
+from tcc.models import (Comment, CommentEvent, ReplyNotAllowed,
+    SpamReport, Subscription, SubscriptionCounter, ThreadParticipant)
 
 
 def make_tree(comments):
@@ -46,9 +59,73 @@ def get_comments_limited(content_type_id, object_pk):
             content_type__id=content_type_id,
             object_pk=object_pk,
         )
+        .with_pending_replies()
     )
 
 
+class PreloadedComments(list):
+    ''' The first page of comments for an object
+
+    `root_count` is the total number of root comments so the paginator
+    can still link to the other pages.
+    '''
+    root_count = 0
+
+
+def get_first_pages_for_objects(objects, per_page=20):
+    ''' Fetches the first page of (limited) comments for all `objects` at
+    once
+
+    Returns a dict which maps (content_type_id, object_pk) to a
+    `PreloadedComments` list. Takes two queries, one counting the roots
+    of every object and one for the comments themselves, plus one per object
+    with more than a page of roots to find where its first page ends.
+    '''
+    content_types = ContentType.objects.get_for_models(
+        *set(type(o) for o in objects))
+    pks_by_ct = {}
+    for o in objects:
+        ct = content_types[type(o)]
+        pks_by_ct.setdefault(ct.id, set()).add(o.pk)
+    if not pks_by_ct:
+        return {}
+
+    q = reduce(operator.or_, [Q(content_type__id=ct_id, object_pk__in=pks)
+                              for ct_id, pks in pks_by_ct.items()])
+    root_counts = {}
+    ranges = []
+    roots = (Comment.limited.filter(q, parent__isnull=True).order_by()
+        .values_list('content_type_id', 'object_pk')
+        .annotate(count=Count('id'), last=Max('sort_date')))
+    for ct_id, object_pk, count, last in roots:
+        root_counts[(ct_id, object_pk)] = count
+  # Same date range ParentCommentPaginator uses for the first page
+        q = Q(content_type__id=ct_id, object_pk=object_pk,
+              sort_date__lte=last)
+        if count > per_page:
+            q &= Q(sort_date__gte=Comment.limited.filter(
+                content_type__id=ct_id, object_pk=object_pk,
+                parent__isnull=True).order_by('-sort_date').values_list(
+                'sort_date', flat=True)[per_page - 1])
+        ranges.append(q)
+
+    preloaded = {}
+    for ct_id, pks in pks_by_ct.items():
+        for object_pk in pks:
+            comments = preloaded[(ct_id, object_pk)] = PreloadedComments()
+            comments.root_count = root_counts.get((ct_id, object_pk), 0)
+    if ranges:
+        comments = (Comment.limited
+            .select_related('user', 'userprofile')
+            .filter(reduce(operator.or_, ranges))
+            .order_by('-sort_date', 'id')
+            .with_pending_replies()
+        )
+        for c in comments:
+            preloaded[(c.content_type_id, c.object_pk)].append(c)
+    return preloaded
+
+
 def get_comments_as_tree(content_type_id, object_pk):
     return make_tree(get_comments(
         content_type_id=content_type_id,
@@ -75,32 +152,33 @@ def get_comments_disapproved(content_type_id, object_pk):
 
 def post_comment(content_type_id, object_pk,
                  user_id, comment, ip, parent_id=None):
-    if parent_id:
-        parent = get_comment(parent_id)
-        if (not parent) or (not parent.is_open):
-            return
+    ''' Returns None if the parent doesn't allow (more) replies '''
     c = Comment(
         content_type_id=content_type_id, object_pk=object_pk,
         user_id=user_id, comment=comment, parent_id=parent_id, ip_address=ip)
-    c.save()
+    try:
+        c.save()
+    except ReplyNotAllowed:
+        return
     return c
 
 
-def post_reply(parent_id, user_id, comment):
+def post_reply(parent_id, user_id, comment, ip):
     ''' Shortcut for post_comment if there is a parent_id '''
     parent = get_comment(parent_id)
-    if (not parent) or (not parent.is_open) or (not parent.reply_allowed()):
+    if not parent:
         return
-    c = Comment(
-        content_type_id=parent.content_type_id, object_pk=parent.object_pk,
-        site_id=parent.site_id, user_id=user_id, comment=comment,
-        parent_id=parent_id)
-    c.save()
-    return c
+    return post_comment(parent.content_type_id, parent.object_pk, user_id,
+                        comment, ip, parent_id=parent_id)
 
 
 def get_comment(comment_id):
     try:
+        if identity.active():
+            c = identity.get(comment_id)
+            if Comment.objects.is_current(c):
+                return c
+            return
         return Comment.objects.get(id=comment_id)
     except ObjectDoesNotExist:
         return
@@ -109,11 +187,11 @@ def get_comment(comment_id):
 def get_comment_thread(comment_id):
     c = get_comment(comment_id)
     if c:
-        return c.get_thread()
+        return c.get_thread().with_pending_replies()
 
 
 def get_comment_replies(comment_id):
-    return Comment.objects.filter(parent=comment_id)
+    return Comment.objects.filter(parent=comment_id).with_pending_replies()
 
 
 def get_comment_parents(comment_id):
@@ -144,8 +222,13 @@ def remove_spam_comment(comment_id, user):
             if c.can_remove_spam(user):
                 c.is_spam = True
                 c.is_removed = True
+                c.save(event=CommentEvent.SPAM)
+            else:
+                c.save(event=created and CommentEvent.FLAGGED or None)
 
-            c.save()
+            if created:
+                dispatch.send(signals.comment_was_flagged,
+                    sender=Comment, comment=c)
 
         else:
             return
@@ -159,18 +242,18 @@ def remove_comment(comment_id, user):
         if not c.can_remove(user):
             return
         c.is_removed = True
-        c.save()
+        c.save(event=CommentEvent.REMOVED)
     return c
 
 
 def restore_comment(comment_id, user):
     ''' restore remove comment '''
     try:
-        c = Comment.unfiltered.get(id=comment_id)
+        c = identity.get(comment_id)
         if not c.can_restore(user):
             return
         c.is_removed = False
-        c.save()
+        c.save(event=CommentEvent.RESTORED)
         return c
     except Comment.DoesNotExist:
         return
@@ -183,18 +266,18 @@ def disapprove_comment(comment_id, user):
         if not c.can_disapprove(user):
             return
         c.is_approved = False
-        c.save()
+        c.save(event=CommentEvent.DISAPPROVED)
     return c
 
 
 def approve_comment(comment_id, user):
     ''' approve comment '''
     try:
-        c = Comment.unfiltered.get(id=comment_id)
+        c = identity.get(comment_id)
         if not c.can_approve(user):
             return
         c.is_approved = True
-        c.save()
+        c.save(event=CommentEvent.APPROVED)
         return c
     except Comment.DoesNotExist:
         return
@@ -226,6 +309,7 @@ def subscribe(comment_id, user):
     r = get_comment_thread_root(comment_id)
     if r:
         r.unsubscribers.remove(user)
+        ThreadParticipant.objects.add(r.id, user.id)
     return r
 
 
@@ -233,9 +317,116 @@ def unsubscribe(comment_id, user):
     r = get_comment_thread_root(comment_id)
     if r:
         r.unsubscribers.add(user)
+        ThreadParticipant.objects.remove(r.id, user.id)
     return r
 
 
+def mark_thread_read(comment_id, user):
+    ''' Marks the subscription of the user to the thread (root comment)
+    read '''
+    return mark_threads_read([comment_id], user)
+
+
+def mark_threads_read(comment_ids, user):
+    ''' Marks the subscriptions of the user to the threads (root comments)
+    read, returns the number of subscriptions marked (None when buffered,
+    see TCC_READ_MARKER_BUFFER) '''
+    if tcc_settings.READ_MARKER_BUFFER:
+        readmarkers.mark_read(user.id, comment_ids, datetime.now())
+        return
+    return Subscription.objects.mark_read(user.id, comment_ids)
+
+
+def mark_inbox_read(user):
+    ''' Marks all subscriptions of the user read '''
+    return Subscription.objects.mark_read(user.id)
+
+
+def get_inbox(user, cursor=None, per_page=20):
+    ''' A page of the visible subscriptions of the user, latest activity
+    first. Returns (subscriptions, cursor of the next page or None). '''
+    after = cursor and utils.decode_cursor(cursor)
+    subscriptions = list(Subscription.objects.inbox_page(user, after,
+        per_page + 1).select_related('comment'))
+    next_cursor = None
+    if len(subscriptions) > per_page:
+        subscriptions = subscriptions[:per_page]
+        last = subscriptions[-1]
+        next_cursor = utils.encode_cursor(last.sort_date, last.comment_id)
+    if tcc_settings.READ_MARKER_BUFFER:
+        readmarkers.apply(user.id, subscriptions)
+    return subscriptions, next_cursor
+
+
+def get_conversations(user, cursor=None, per_page=20, content_type_id=None):
+    ''' A page of the private threads of the user, latest activity first,
+    like `get_inbox`. Every subscription gets a `last_message`: the latest
+    reply of the thread the user may see (see
+    `CommentManager.private_message`), or the thread itself. Takes two to
+    four queries. The page is empty if 'user.profile' isn't one of the
+    TCC_CONTENT_TYPES. '''
+    if content_type_id is None:
+        content_type_id = utils.get_content_type_id('user.profile')
+  # without it inbox_page would return every thread
+        if content_type_id is None:
+            return [], None
+    after = cursor and utils.decode_cursor(cursor)
+    subscriptions = list(Subscription.objects.inbox_page(user, after,
+        per_page + 1, content_type_id).select_related('comment'))
+    next_cursor = None
+    if len(subscriptions) > per_page:
+        subscriptions = subscriptions[:per_page]
+        last = subscriptions[-1]
+        next_cursor = utils.encode_cursor(last.sort_date, last.comment_id)
+
+  # the last reply of a thread has index == child_count, the whole page is
+  # fetched at once through the (content_type, object_pk, parent, index) key;
+  # the threads where that reply isn't visible to the user (or child_count
+  # lags behind, with TCC_COALESCE_REPLIES) get their newest visible one
+    visible = (Q(spam_status__isnull=False, is_removed=False)
+               | Q(user=user))
+    replies = {}
+    missed = [s.comment for s in subscriptions
+              if tcc_settings.COALESCE_REPLIES or s.comment.child_count]
+    if missed and not tcc_settings.COALESCE_REPLIES:
+        replies = _get_replies_at(visible, [(c, c.child_count)
+                                            for c in missed])
+        missed = [c for c in missed if c.id not in replies]
+    if missed:
+        last = (Comment.unfiltered.filter(visible, parent__in=missed)
+                .order_by().values('parent').annotate(last=Max('index')))
+        parents = dict((c.id, c) for c in missed)
+        replies.update(_get_replies_at(visible,
+            [(parents[row['parent']], row['last']) for row in last]))
+    for s in subscriptions:
+        s.last_message = replies.get(s.comment_id, s.comment)
+
+    if tcc_settings.READ_MARKER_BUFFER:
+        readmarkers.apply(user.id, subscriptions)
+    return subscriptions, next_cursor
+
+
+def _get_replies_at(visible, positions):
+    ''' {parent id: reply} of the visible replies at the (parent, index)
+    positions '''
+    if not positions:
+        return {}
+    q = reduce(operator.or_, [Q(content_type=parent.content_type_id,
+                                object_pk=parent.object_pk,
+                                parent=parent.id, index=index)
+                              for parent, index in positions])
+    return dict((c.parent_id, c)
+                for c in Comment.unfiltered.filter(q).filter(visible))
+
+
+def get_unread_count(user_id):
+    ''' The number of unread threads in the inbox of the user '''
+    unread = SubscriptionCounter.objects.get_for_user(user_id).unread
+    if tcc_settings.READ_MARKER_BUFFER:
+        unread -= readmarkers.count_buffered_unread(user_id)
+    return unread
+
+
 def get_user_comments(user_id,
                       content_type_id=None, object_pk=None, site_id=None):
     ''' Returns all (approved, unremoved) comments by user '''
@@ -244,7 +435,30 @@ def get_user_comments(user_id,
         extra['content_type__id'] = content_type_id
     if object_pk:
         extra['object_pk'] = object_pk
-    if site_id:
-        extra['site__id'] = site_id
+  # site_id is ignored, comments aren't tied to a site
     return Comment.objects.filter(user__id=user_id, **extra)
 
+
+def get_user_activity(user_id, cursor=None, per_page=20,
+                      content_type_id=None):
+    ''' A page of the (unremoved) comments by the user, newest first, with
+    their content_object prefetched (one query per content type). Returns
+    (comments, cursor of the next page or None). '''
+    comments = Comment.objects.filter(user=user_id, is_removed=False)
+    if content_type_id:
+        comments = comments.filter(content_type=content_type_id)
+    after = cursor and utils.decode_cursor(cursor)
+    if after:
+        submit_date, id = after
+        comments = comments.filter(Q(submit_date__lt=submit_date)
+            | Q(submit_date=submit_date, id__lt=id))
+    comments = list(comments.order_by('-submit_date', '-id')
+        .prefetch_related('content_object')[:per_page + 1])
+
+    next_cursor = None
+    if len(comments) > per_page:
+        comments = comments[:per_page]
+        next_cursor = utils.encode_cursor(comments[-1].submit_date,
+                                          comments[-1].id)
+    return comments, next_cursor
+
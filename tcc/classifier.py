@@ -0,0 +1,143 @@
+'''
+Naive Bayes spam pre-filter.
+
+Trained from the spam_status of existing comments by the
+`tcc_train_classifier` command and stored (compressed) at
+TCC_SPAM_CLASSIFIER. Comments it is confident about are classified locally,
+only the uncertain ones are sent to Akismet.
+'''
+import cPickle as pickle
+import math
+import os
+import re
+import threading
+import zlib
+
+from django.template.defaultfilters import striptags
+
+from tcc import settings as tcc_settings
+
+FORMAT_VERSION = 1
+
+_TOKEN = re.compile(r'[^\W\d_]{3,30}', re.UNICODE)
+
+_classifier = None
+_classifier_mtime = None
+_lock = threading.Lock()
+
+stats = {'spam': 0, 'ham': 0, 'uncertain': 0}
+_stats_lock = threading.Lock()
+
+
+def tokenize(text):
+    ''' The set of (lower case) words in `text` '''
+    return set(_TOKEN.findall(striptags(text).lower()))
+
+
+class NaiveBayes(object):
+    ''' Naive Bayes over the words occurring in a comment '''
+
+    def __init__(self, min_examples=100):
+        self.min_examples = min_examples
+        self.spam_count = 0
+        self.ham_count = 0
+  # token -> [spam count, ham count]
+        self.tokens = {}
+
+    def train(self, text, is_spam):
+        if is_spam:
+            self.spam_count += 1
+        else:
+            self.ham_count += 1
+        index = 0 if is_spam else 1
+        for token in tokenize(text):
+            self.tokens.setdefault(token, [0, 0])[index] += 1
+
+    def prune(self, min_count=2):
+        ''' Drops the tokens seen less than `min_count` times '''
+        self.tokens = dict((token, counts)
+                           for token, counts in self.tokens.iteritems()
+                           if sum(counts) >= min_count)
+
+    def spam_probability(self, text):
+        total = self.spam_count + self.ham_count
+        log_spam = math.log((self.spam_count + 1.0) / (total + 2))
+        log_ham = math.log((self.ham_count + 1.0) / (total + 2))
+        for token in tokenize(text):
+            counts = self.tokens.get(token)
+            if counts is None:
+                continue
+            log_spam += math.log((counts[0] + 1.0) / (self.spam_count + 2))
+            log_ham += math.log((counts[1] + 1.0) / (self.ham_count + 2))
+        diff = max(min(log_ham - log_spam, 700), -700)
+        return 1.0 / (1.0 + math.exp(diff))
+
+    def classify(self, text, ham_threshold=tcc_settings.SPAM_CLASSIFIER_HAM,
+                 spam_threshold=tcc_settings.SPAM_CLASSIFIER_SPAM):
+        ''' Returns True (spam), False (ham) or None if it isn't sure '''
+        if min(self.spam_count, self.ham_count) < self.min_examples:
+            return None
+        probability = self.spam_probability(text)
+        if probability >= spam_threshold:
+            return True
+        if probability <= ham_threshold:
+            return False
+        return None
+
+    def save(self, path):
+        data = zlib.compress(pickle.dumps((
+            FORMAT_VERSION,
+            self.min_examples,
+            self.spam_count,
+            self.ham_count,
+            self.tokens,
+        ), pickle.HIGHEST_PROTOCOL))
+  # write and rename so running processes never load a partial model
+        tmp_path = '%s.%d.tmp' % (path, os.getpid())
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.rename(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'rb') as f:
+            data = pickle.loads(zlib.decompress(f.read()))
+        if data[0] != FORMAT_VERSION:
+            raise ValueError('Unsupported classifier format %r' % data[0])
+        classifier = cls(min_examples=data[1])
+        classifier.spam_count, classifier.ham_count, classifier.tokens = \
+            data[2:]
+        return classifier
+
+
+def get_classifier():
+    ''' The classifier stored at TCC_SPAM_CLASSIFIER, reloaded when the file
+    changes. Returns None if there is none. '''
+    global _classifier, _classifier_mtime
+    path = tcc_settings.SPAM_CLASSIFIER
+    if not path:
+        return None
+    try:
+        mtime = os.path.getmtime(path)
+    except OSError:
+        return None
+    if mtime != _classifier_mtime:
+        with _lock:
+            if mtime != _classifier_mtime:
+                _classifier = NaiveBayes.load(path)
+                _classifier_mtime = mtime
+    return _classifier
+
+
+def classify(text):
+    ''' Returns True (spam), False (ham) or None if the classifier isn't
+    sure (or there is no classifier) '''
+    classifier = get_classifier()
+    if classifier is None:
+        return None
+    is_spam = classifier.classify(text)
+    key = {True: 'spam', False: 'ham', None: 'uncertain'}[is_spam]
+  # classify runs in the spam check pool
+    with _stats_lock:
+        stats[key] += 1
+    return is_spam
@@ -0,0 +1,212 @@
+'''
+Deferred signal dispatch.
+
+With TCC_DEFERRED_SIGNALS enabled `comment_was_posted` and
+`comment_was_flagged` are no longer handled inline. Their events are queued
+per thread (by `tcc.middleware.DeferredSignalMiddleware` or the `deferred()`
+context manager) and handed to a pool of worker threads once the request is
+done, that is after TransactionMiddleware committed. The events of a failed
+request are discarded. Events sent outside of a request are handed to the
+workers right away.
+
+The workers deliver the events in batches, drop duplicates (the same signal
+for the same comment) and time every receiver, see `get_stats()`.
+
+`after_commit()` holds back calls the same way (whether or not
+TCC_DEFERRED_SIGNALS is enabled), e.g. queueing the spam check of a new
+comment, which the background checker couldn't load before the commit.
+'''
+import logging
+import Queue
+import threading
+import time
+from contextlib import contextmanager
+
+from django.db import connection
+from django.dispatch.dispatcher import _make_id
+
+from tcc import settings as tcc_settings
+from tcc import signals
+from tcc.utils import LatencyStats
+
+logger = logging.getLogger(__name__)
+
+DEFERRED = (signals.comment_was_posted, signals.comment_was_flagged)
+
+_local = threading.local()
+_dispatcher = None
+_dispatcher_lock = threading.Lock()
+
+stats = LatencyStats()
+
+
+def _receiver_name(receiver):
+    return '%s.%s' % (getattr(receiver, '__module__', None),
+                      getattr(receiver, '__name__', repr(receiver)))
+
+
+def deliver(signal, sender, **kwargs):
+    ''' Calls the receivers of `signal` one by one, timing them. A failing
+    receiver is logged and doesn't stop the others. '''
+    for receiver in signal._live_receivers(_make_id(sender)):
+        start = time.time()
+        error = False
+        try:
+            receiver(signal=signal, sender=sender, **kwargs)
+        except Exception:
+            error = True
+            logger.exception('Receiver %s failed', _receiver_name(receiver))
+        stats.add(_receiver_name(receiver), time.time() - start, error)
+
+
+def coalesce(events):
+    ''' Drops the repeated (signal, sender, comment) events, keeping the
+    order of the first ones '''
+    seen = set()
+    unique = []
+    for signal, sender, kwargs in events:
+        comment = kwargs.get('comment')
+        key = (id(signal), _make_id(sender),
+               getattr(comment, 'id', None) or id(comment))
+        if key not in seen:
+            seen.add(key)
+            unique.append((signal, sender, kwargs))
+    return unique
+
+
+class Dispatcher(object):
+    ''' Delivers queued events from `workers` background threads, in batches
+    of at most `batch_size` collected for at most `interval` seconds '''
+
+    def __init__(self, workers=tcc_settings.DEFERRED_SIGNAL_WORKERS,
+                 batch_size=tcc_settings.DEFERRED_SIGNAL_BATCH_SIZE,
+                 interval=tcc_settings.DEFERRED_SIGNAL_INTERVAL):
+        self.workers = workers
+        self.batch_size = batch_size
+        self.interval = interval
+        self.queue = Queue.Queue()
+        self._threads = []
+        self._lock = threading.Lock()
+
+    def submit(self, events):
+        self._start()
+        for event in events:
+            self.queue.put(event)
+
+    def join(self):
+        ''' Blocks until all submitted events are delivered '''
+        self.queue.join()
+
+    def _start(self):
+        if not self._threads:
+            with self._lock:
+                if not self._threads:
+                    for i in range(self.workers):
+                        thread = threading.Thread(target=self._run,
+                            name='tcc-dispatch-%d' % i)
+                        thread.daemon = True
+                        thread.start()
+                        self._threads.append(thread)
+
+    def _get_batch(self):
+        batch = [self.queue.get()]
+        deadline = time.time() + self.interval
+        while len(batch) < self.batch_size:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self.queue.get(timeout=timeout))
+            except Queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._get_batch()
+            try:
+                for signal, sender, kwargs in coalesce(batch):
+                    deliver(signal, sender, **kwargs)
+            finally:
+                connection.close()
+                for _ in batch:
+                    self.queue.task_done()
+
+
+def get_dispatcher():
+    global _dispatcher
+    if _dispatcher is None:
+        with _dispatcher_lock:
+            if _dispatcher is None:
+                _dispatcher = Dispatcher()
+    return _dispatcher
+
+
+def send(signal, sender, **kwargs):
+    ''' Sends `signal`, or queues it if it's one of the deferred signals and
+    TCC_DEFERRED_SIGNALS is enabled (returning no responses) '''
+    if not tcc_settings.DEFERRED_SIGNALS or signal not in DEFERRED:
+        return signal.send(sender=sender, **kwargs)
+    event = (signal, sender, kwargs)
+    queue = getattr(_local, 'queue', None)
+    if queue is None:
+        get_dispatcher().submit([event])
+    else:
+        queue.append(event)
+    return []
+
+
+def after_commit(func, *args):
+    ''' Calls `func` once the events of this thread are handed over, or
+    right away if they aren't queued '''
+    callbacks = getattr(_local, 'callbacks', None)
+    if callbacks is None:
+        func(*args)
+    else:
+        callbacks.append((func, args))
+
+
+def begin():
+    ''' Starts queueing the events sent by this thread '''
+    _local.queue = []
+    _local.callbacks = []
+
+
+def commit():
+    ''' Hands the queued events to the workers and makes the held back
+    calls '''
+    queue = getattr(_local, 'queue', None)
+    callbacks = getattr(_local, 'callbacks', None)
+    discard()
+    if queue:
+        get_dispatcher().submit(queue)
+    for func, args in callbacks or ():
+        try:
+            func(*args)
+        except Exception:
+            logger.exception('Call to %s failed', _receiver_name(func))
+
+
+def discard():
+    ''' Drops the queued events and calls '''
+    _local.queue = None
+    _local.callbacks = None
+
+
+@contextmanager
+def deferred():
+    ''' Queues the events sent within the block and hands them to the
+    workers only if it completes, for use outside of requests (wrap it
+    around the transaction) '''
+    begin()
+    try:
+        yield
+    except:
+        discard()
+        raise
+    commit()
+
+
+def get_stats():
+    ''' Call counts and timings per receiver '''
+    return stats.as_dict()
@@ -0,0 +1,67 @@
+'''
+Comment event outbox.
+
+With TCC_EVENT_OUTBOX enabled every change to a comment (posted, removed,
+restored, approved, disapproved, spam, ham, flagged, deleted) also writes a
+CommentEvent row, in the same transaction. Consumers registered in
+TCC_EVENT_CONSUMERS read them in id order through `consume` (usually from
+the `tcc_consume_events` command); each keeps its own high-water mark in
+EventCursor, which is only moved once a batch is handled, so events are
+delivered at least once and consumers have to be idempotent.
+
+Ids are taken on insert, not on commit, so an event may show up after one
+with a higher id was consumed already. Events are only handed out once they
+are TCC_EVENT_SETTLE_TIME seconds old, by when the transactions that wrote
+the lower ids have committed (or rolled back).
+'''
+from datetime import datetime, timedelta
+
+from django.core.urlresolvers import get_callable
+
+from tcc.models import CommentEvent, EventCursor
+from tcc import settings as tcc_settings
+
+
+def get_consumers():
+    return dict((name, get_callable(path))
+                for name, path in tcc_settings.EVENT_CONSUMERS.items())
+
+
+def consume(name, consumer, batch_size=500, settle_time=None):
+    ''' Hands the settled events after the high-water mark of `name` to
+    `consumer`, in batches of `batch_size`. Returns the number of events
+    handled. '''
+    if settle_time is None:
+        settle_time = tcc_settings.EVENT_SETTLE_TIME
+    settled = CommentEvent.objects.filter(
+        created_at__lte=datetime.now() - timedelta(seconds=settle_time))
+    cursor, created = EventCursor.objects.get_or_create(name=name)
+    total = 0
+    while True:
+        events = list(settled.filter(id__gt=cursor.last_id)
+            .order_by('id')[:batch_size])
+        if not events:
+            break
+
+        consumer(events)
+        cursor.last_id = events[-1].id
+        EventCursor.objects.filter(id=cursor.id).update(
+            last_id=cursor.last_id)
+        total += len(events)
+    return total
+
+
+def prune():
+    ''' Deletes the events all registered consumers are done with '''
+    names = tcc_settings.EVENT_CONSUMERS.keys()
+    if not names:
+        return 0
+    cursors = EventCursor.objects.filter(name__in=names)
+    last_ids = list(cursors.values_list('last_id', flat=True))
+    if len(last_ids) < len(names):
+  # a consumer that never ran still needs all events
+        return 0
+    events = CommentEvent.objects.filter(id__lte=min(last_ids))
+    count = events.count()
+    events.delete()
+    return count
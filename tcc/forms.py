@@ -2,11 +2,25 @@ import time
 
 from django import forms
 from django.conf import settings
+from django.core.cache import cache
+from django.forms.forms import NON_FIELD_ERRORS
 from django.utils.crypto import salted_hmac, constant_time_compare
-from django.utils.hashcompat import sha_constructor
+from django.utils.encoding import smart_str
+from django.utils.hashcompat import sha_constructor, md5_constructor
+from django.utils.safestring import mark_safe
 from django.utils.translation import ugettext_lazy as _
 
 from tcc.models import Comment
+from tcc import ratelimit
+from tcc import settings as tcc_settings
+
+
+def get_security_timestamp():
+    ''' The current time rounded down to TCC_FORM_TIMESTAMP_BUCKET '''
+    timestamp = int(time.time())
+    if tcc_settings.FORM_TIMESTAMP_BUCKET:
+        timestamp -= timestamp % tcc_settings.FORM_TIMESTAMP_BUCKET
+    return timestamp
 
 
 class CommentForm(forms.ModelForm):
@@ -31,6 +45,9 @@ class CommentForm(forms.ModelForm):
         self.ip = ip
         super(CommentForm, self).__init__(data=data, initial=self.initial)
 
+    def render_fields(self):
+        return mark_safe(u''.join(fld.as_widget() for fld in self))
+
     def save(self, commit=True):
         instance = forms.ModelForm.save(self, commit=False)
         assert self.ip, 'Unable to save without an IP address'
@@ -53,6 +70,18 @@ class CommentForm(forms.ModelForm):
             object_pk = self.data['object_pk']
         return object_pk
 
+    def full_clean(self):
+        """ Reject floods (TCC_RATE_LIMITS) before any validation or query
+        runs. """
+        if self.is_bound and not ratelimit.allow(
+                user_id=self.data.get('user'), ip=self.ip):
+            self.cleaned_data = {}
+            self._errors = forms.ErrorDict()
+            self._errors[NON_FIELD_ERRORS] = self.error_class(
+                [_("You are posting too fast, please wait a moment.")])
+            return
+        super(CommentForm, self).full_clean()
+
     def clean(self):
         """ Check that the user has not posted too many comments today.
         """
@@ -104,7 +133,7 @@ class CommentForm(forms.ModelForm):
 
     def generate_security_data(self):
         """Generate a dict of security data for "initial" data."""
-        timestamp = int(time.time())
+        timestamp = get_security_timestamp()
         security_dict =   {
             'content_type'  : str(self.content_type),
             'object_pk'     : str(self.object_pk),
@@ -161,3 +190,61 @@ class CommentForm(forms.ModelForm):
             'parent': forms.HiddenInput,
         }
 
+
+
+class LazyCommentForm(object):
+    """
+    Stand-in for an unbound CommentForm on read-only renders.
+
+    The CommentForm (and its security hash) is only built once the template
+    actually uses it. `render_fields()` caches the rendered fields per
+    content type, object, `next` and timestamp bucket.
+    """
+
+    def __init__(self, content_type_id, object_pk, initial=None):
+        self.initial = dict(initial or {})
+        self.initial['content_type'] = content_type_id
+        self.initial['object_pk'] = object_pk
+        self._form = None
+
+    @property
+    def form(self):
+        if self._form is None:
+            self._form = CommentForm(initial=dict(self.initial))
+        return self._form
+
+    @property
+    def media(self):
+        media = forms.Media()
+        for field in CommentForm.base_fields.values():
+            media = media + field.widget.media
+        return media
+
+    def __iter__(self):
+        return iter(self.form)
+
+    def __getitem__(self, name):
+        return self.form[name]
+
+    def __getattr__(self, name):
+        return getattr(self.form, name)
+
+    def _get_cache_key(self, timestamp):
+        return 'tcc:form:%s:%s:%d:%s' % (
+            self.initial['content_type'],
+            self.initial['object_pk'],
+            timestamp,
+            md5_constructor(smart_str(self.initial.get('next') or '')
+                ).hexdigest(),
+        )
+
+    def render_fields(self):
+        if not tcc_settings.FORM_TIMESTAMP_BUCKET:
+            return self.form.render_fields()
+
+        key = self._get_cache_key(get_security_timestamp())
+        html = cache.get(key)
+        if html is None:
+            html = self.form.render_fields()
+            cache.set(key, html, tcc_settings.FORM_TIMESTAMP_BUCKET)
+        return mark_safe(html)
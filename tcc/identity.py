@@ -0,0 +1,132 @@
+'''
+Request scoped identity map for comments.
+
+Within `scope()` (or a request handled by
+`tcc.middleware.IdentityMapMiddleware`) every comment row is loaded at most
+once: the `tcc.api` getters and the `Comment.parent` accessor return the
+instance loaded before. Changes made through those instances are seen by
+every later lookup; rows updated with a queryset UPDATE are refreshed or
+dropped from the map by the code doing so. Outside a scope nothing is cached.
+'''
+import logging
+import threading
+from contextlib import contextmanager
+
+from django.db.models.fields.related import (
+    ReverseSingleRelatedObjectDescriptor)
+
+logger = logging.getLogger(__name__)
+
+_local = threading.local()
+_lock = threading.Lock()
+
+stats = {'hits': 0, 'misses': 0}
+
+
+class IdentityMap(object):
+
+    def __init__(self):
+        self.comments = {}
+        self.hits = 0
+        self.misses = 0
+
+
+def current():
+    ''' The map of this thread, None outside a scope '''
+    return getattr(_local, 'map', None)
+
+
+def active():
+    return current() is not None
+
+
+def begin():
+    _local.map = IdentityMap()
+
+
+def end():
+    identity_map = current()
+    _local.map = None
+    if identity_map is not None:
+        with _lock:
+            stats['hits'] += identity_map.hits
+            stats['misses'] += identity_map.misses
+        logger.debug('Identity map: %d comments, %d hits',
+                     identity_map.misses, identity_map.hits)
+
+
+@contextmanager
+def scope():
+    ''' Keeps an identity map for the block (nested scopes share it) '''
+    if active():
+        yield current()
+        return
+    begin()
+    try:
+        yield current()
+    finally:
+        end()
+
+
+def get(comment_id):
+    ''' Like `Comment.unfiltered.get(id=comment_id)`, but from the map if
+    the comment was loaded in this scope before '''
+    from tcc.models import Comment
+    identity_map = current()
+    if identity_map is None:
+        return Comment.unfiltered.get(id=comment_id)
+
+    comment_id = int(comment_id)
+    if comment_id in identity_map.comments:
+        identity_map.hits += 1
+        comment = identity_map.comments[comment_id]
+    else:
+        identity_map.misses += 1
+        try:
+            comment = Comment.unfiltered.get(id=comment_id)
+        except Comment.DoesNotExist:
+            comment = None
+        identity_map.comments[comment_id] = comment
+    if comment is None:
+        raise Comment.DoesNotExist('Comment %d does not exist' % comment_id)
+    return comment
+
+
+def add(comment):
+    identity_map = current()
+    if identity_map is not None:
+        identity_map.comments.setdefault(comment.id, comment)
+
+
+def update(comment_id, **fields):
+    ''' Applies the fields of a queryset UPDATE to the mapped instance '''
+    identity_map = current()
+    comment = identity_map and identity_map.comments.get(comment_id)
+    if comment is not None:
+        for name, value in fields.items():
+            setattr(comment, name, value)
+
+
+def discard(comment_ids):
+    identity_map = current()
+    if identity_map is not None:
+        for comment_id in comment_ids:
+            identity_map.comments.pop(comment_id, None)
+
+
+def get_stats():
+    ''' The hits (saved queries) and misses of all finished scopes '''
+    with _lock:
+        return dict(stats)
+
+
+class ParentDescriptor(ReverseSingleRelatedObjectDescriptor):
+    ''' `Comment.parent`, consulting the identity map '''
+
+    def __get__(self, instance, instance_type=None):
+        if (instance is not None and instance.parent_id is not None
+                and active()
+                and not hasattr(instance, self.field.get_cache_name())):
+            setattr(instance, self.field.get_cache_name(),
+                    get(instance.parent_id))
+        return super(ParentDescriptor, self).__get__(instance, instance_type)
@@ -0,0 +1,37 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from tcc import events
+
+
+class Command(BaseCommand):
+    args = '[consumer ...]'
+    help = ('Hands the new comment events to the TCC_EVENT_CONSUMERS '
+            '(all of them unless names are given)')
+
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size', dest='batch_size', type='int',
+            default=500, help='Number of events per batch'),
+        make_option('--prune', dest='prune', action='store_true',
+            default=False,
+            help='Delete the events all consumers have handled'),
+    )
+
+    def handle(self, *args, **options):
+        verbosity = int(options.get('verbosity', 1))
+        consumers = events.get_consumers()
+        for name in args:
+            if name not in consumers:
+                raise CommandError('Unknown consumer %r' % name)
+
+        for name in args or sorted(consumers):
+            count = events.consume(name, consumers[name],
+                                   batch_size=options['batch_size'])
+            if verbosity:
+                self.stdout.write('%s: %d events\n' % (name, count))
+
+        if options['prune']:
+            count = events.prune()
+            if verbosity:
+                self.stdout.write('Pruned %d events\n' % count)
@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+
+from tcc import readmarkers
+
+
+class Command(BaseCommand):
+    help = ('Writes the read markers buffered in the cache to the database '
+            '(see TCC_READ_MARKER_BUFFER)')
+
+    def handle(self, *args, **options):
+        count = readmarkers.flush()
+        if int(options.get('verbosity', 1)):
+            if count is None:
+                self.stdout.write('Another flush is running\n')
+            else:
+                self.stdout.write('Flushed %d read markers\n' % count)
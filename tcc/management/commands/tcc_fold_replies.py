@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+
+from tcc.models import ReplyDelta
+
+
+class Command(BaseCommand):
+    help = ('Folds the pending replies into the child_count and sort_date '
+            'of their parents (see TCC_COALESCE_REPLIES)')
+
+    def handle(self, *args, **options):
+        count = ReplyDelta.objects.fold()
+        if int(options.get('verbosity', 1)):
+            self.stdout.write('Folded %d replies\n' % count)
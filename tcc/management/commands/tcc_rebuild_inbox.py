@@ -0,0 +1,52 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from tcc.models import Subscription, SubscriptionCounter
+
+
+class Command(BaseCommand):
+    help = ('Copies the sort_date and visibility of the threads to the '
+            'subscriptions and recounts the inbox counters of all users')
+
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size', dest='batch_size', type='int',
+            default=500, help='Number of threads / users per batch'),
+    )
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        verbosity = int(options.get('verbosity', 1))
+
+        comment_ids = (Subscription.objects.order_by('comment')
+            .values_list('comment', flat=True).distinct())
+
+        last_id = 0
+        while True:
+            batch = list(comment_ids.filter(comment__gt=last_id)[:batch_size])
+            if not batch:
+                break
+            Subscription.objects.sync_sort_dates(batch)
+            Subscription.objects.sync_visibility(batch, counters=False)
+            last_id = batch[-1]
+            if verbosity > 1:
+                self.stdout.write('Synced threads up to id %d\n' % last_id)
+
+        user_ids = (Subscription.objects.order_by('user')
+            .values_list('user', flat=True).distinct())
+
+        last_id = 0
+        total = 0
+        while True:
+            batch = list(user_ids.filter(user__gt=last_id)[:batch_size])
+            if not batch:
+                break
+            SubscriptionCounter.objects.rebuild(batch)
+            last_id = batch[-1]
+            total += len(batch)
+            if verbosity > 1:
+                self.stdout.write('Rebuilt %d counters (up to user %d)\n'
+                    % (total, last_id))
+
+        if verbosity:
+            self.stdout.write('Rebuilt %d counters\n' % total)
@@ -0,0 +1,63 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from tcc.models import Comment, Subscription, ThreadParticipant
+
+
+class Command(BaseCommand):
+    help = ('Rebuilds the thread participants from the authors and the '
+            'subscribers (subscriptions and participants added by '
+            'subscribing) minus the unsubscribers')
+
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size', dest='batch_size', type='int',
+            default=500, help='Number of threads per transaction'),
+    )
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        verbosity = int(options.get('verbosity', 1))
+
+        roots = Comment.unfiltered.filter(parent__isnull=True).order_by('id')
+        unsubscribers = Comment.unsubscribers.through.objects
+
+        last_id = 0
+        total = 0
+        while True:
+            root_ids = list(roots.filter(id__gt=last_id)
+                .values_list('id', flat=True)[:batch_size])
+            if not root_ids:
+                break
+
+            participants = set()
+            for id, parent_id, user_id in Comment.unfiltered.filter(
+                    parent__in=root_ids).values_list(
+                    'id', 'parent_id', 'user_id'):
+                participants.add((parent_id, user_id))
+            for id, user_id in roots.filter(id__in=root_ids).values_list(
+                    'id', 'user_id'):
+                participants.add((id, user_id))
+  # subscribe() only leaves a participant row behind, so those are kept
+            participants.update(Subscription.objects.filter(
+                comment__in=root_ids).values_list('comment_id', 'user_id'))
+            participants.update(ThreadParticipant.objects.filter(
+                root__in=root_ids).values_list('root_id', 'user_id'))
+            participants -= set(unsubscribers.filter(
+                comment__in=root_ids).values_list('comment_id', 'user_id'))
+
+            with transaction.commit_on_success():
+                ThreadParticipant.objects.filter(root__in=root_ids).delete()
+                ThreadParticipant.objects.bulk_create([
+                    ThreadParticipant(root_id=root_id, user_id=user_id)
+                    for root_id, user_id in participants])
+
+            last_id = root_ids[-1]
+            total += len(participants)
+            if verbosity > 1:
+                self.stdout.write('Added %d participants (up to id %d)\n'
+                    % (total, last_id))
+
+        if verbosity:
+            self.stdout.write('Added %d participants\n' % total)
@@ -0,0 +1,114 @@
+import os
+import time
+from multiprocessing.pool import ThreadPool
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from tcc import spam
+from tcc.models import Comment
+from tcc import settings as tcc_settings
+
+
+class Command(BaseCommand):
+    help = ('Checks all unchecked comments (spam_status NULL) for spam, '
+            'e.g. after an Akismet outage')
+
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size', dest='batch_size', type='int',
+            default=500, help='Number of comments per batch (and UPDATE)'),
+        make_option('--concurrency', dest='concurrency', type='int',
+            default=tcc_settings.AKISMET_CONCURRENCY,
+            help='Number of concurrent Akismet calls'),
+        make_option('--rate', dest='rate', type='float', default=0,
+            help='Maximum number of Akismet calls per second (0: no limit)'),
+        make_option('--checkpoint', dest='checkpoint', default=None,
+            help='File which keeps the last checked id, to resume from'),
+        make_option('--start-id', dest='start_id', type='int', default=None,
+            help='Start after this id (ignores the checkpoint)'),
+        make_option('--retries', dest='retries', type='int', default=2,
+            help='Number of times the failed checks of a batch are retried'),
+    )
+
+    def _read_checkpoint(self, path):
+        if path and os.path.exists(path):
+            with open(path) as f:
+                return int(f.read().strip() or 0)
+        return 0
+
+    def _write_checkpoint(self, path, last_id):
+        if path:
+            tmp_path = path + '.tmp'
+            with open(tmp_path, 'w') as f:
+                f.write('%d\n' % last_id)
+            os.rename(tmp_path, path)
+
+    def handle(self, *args, **options):
+        verbosity = int(options.get('verbosity', 1))
+        checkpoint = options['checkpoint']
+        last_id = options['start_id']
+        if last_id is None:
+            last_id = self._read_checkpoint(checkpoint)
+
+        pool = ThreadPool(options['concurrency'])
+        limiter = options['rate'] and spam.RateLimiter(options['rate']) or None
+        breaker = getattr(spam.get_client(), 'breaker', None)
+
+  # Walks the id index (keyset pagination) instead of OFFSETs, so every
+  # batch is a cheap range scan no matter how far along we are
+        unchecked = Comment.unfiltered.filter(
+            spam_status__isnull=True).order_by('id')
+        totals = {True: 0, False: 0, None: 0}
+  # the checkpoint stays before the first comment that couldn't be checked,
+  # so a resumed run tries it again
+        failed_id = None
+        start = time.time()
+        try:
+            while True:
+                comments = list(unchecked.filter(id__gt=last_id)
+                    [:options['batch_size']])
+                if not comments:
+                    break
+
+                verdicts = spam.check_comment_list(comments, pool=pool,
+                                                   limiter=limiter)
+                for _ in range(options['retries']):
+                    failed = [c for c in comments if verdicts[c.id] is None]
+                    if not failed or (breaker is not None
+                                      and breaker.state == breaker.OPEN):
+                        break
+                    verdicts.update(spam.check_comment_list(failed,
+                        pool=pool, limiter=limiter))
+
+                if breaker is not None and breaker.state == breaker.OPEN:
+  # Akismet is down (again); wait and retry this batch, the comments that
+  # did get checked are skipped the next time around
+                    retry_in = breaker.as_dict()['retry_in'] or 1
+                    if verbosity:
+                        self.stdout.write('Akismet unavailable, retrying '
+                            'in %d seconds\n' % retry_in)
+                    time.sleep(retry_in)
+                    continue
+
+                for is_spam in verdicts.values():
+                    totals[is_spam] += 1
+                failed = [c.id for c in comments if verdicts[c.id] is None]
+                if failed and failed_id is None:
+                    failed_id = failed[0]
+                last_id = comments[-1].id
+                if failed_id is None:
+                    self._write_checkpoint(checkpoint, last_id)
+                else:
+                    self._write_checkpoint(checkpoint, failed_id - 1)
+
+                if verbosity:
+                    checked = sum(totals.values())
+                    self.stdout.write(
+                        '%d checked (%d spam, %d ham, %d failed) up to id '
+                        '%d, %.1f comments/s\n' % (
+                            checked, totals[True], totals[False],
+                            totals[None], last_id,
+                            checked / max(time.time() - start, 0.001)))
+        finally:
+            pool.close()
+            pool.join()
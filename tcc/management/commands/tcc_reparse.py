@@ -0,0 +1,50 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from tcc.models import Comment
+from tcc import settings as tcc_settings
+
+
+class Command(BaseCommand):
+    help = ('Re-parses all comments that were parsed with an older '
+            'TCC_PARSER_VERSION')
+
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size', dest='batch_size', type='int',
+            default=500, help='Number of comments per transaction'),
+    )
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        verbosity = int(options.get('verbosity', 1))
+
+        stale = Comment.unfiltered.filter(
+            parser_version__lt=tcc_settings.PARSER_VERSION).order_by('id')
+
+        last_id = 0
+        total = 0
+        while True:
+            batch = list(stale.filter(id__gt=last_id)[:batch_size])
+            if not batch:
+                break
+
+            with transaction.commit_on_success():
+                for comment in batch:
+                    # responses are ignored, rejecting an existing comment
+                    # is up to the moderation tools
+                    comment.parse()
+                    Comment.unfiltered.filter(id=comment.id).update(
+                        comment=comment.comment,
+                        parser_version=comment.parser_version,
+                    )
+
+            last_id = batch[-1].id
+            total += len(batch)
+            if verbosity > 1:
+                self.stdout.write('Re-parsed %d comments (up to id %d)\n'
+                    % (total, last_id))
+
+        if verbosity:
+            self.stdout.write('Re-parsed %d comments\n' % total)
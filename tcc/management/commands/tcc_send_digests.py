@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+
+from tcc import notifications
+
+
+class Command(BaseCommand):
+    help = ('Sends every subscriber one mail with the new replies in the '
+            'threads they follow (see TCC_NOTIFICATION_DIGEST)')
+
+    def handle(self, *args, **options):
+        sent = notifications.send_digests()
+        if int(options.get('verbosity', 1)):
+            self.stdout.write('Sent %d digests\n' % sent)
@@ -0,0 +1,62 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from tcc.classifier import NaiveBayes
+from tcc.models import Comment
+from tcc.spam import SPAM
+from tcc import settings as tcc_settings
+
+
+class Command(BaseCommand):
+    help = ('Trains the local spam classifier on the spam_status of the '
+            'existing comments')
+
+    option_list = BaseCommand.option_list + (
+        make_option('--output', dest='output',
+            default=tcc_settings.SPAM_CLASSIFIER,
+            help='Where to store the model (defaults to TCC_SPAM_CLASSIFIER)'),
+        make_option('--checked-only', dest='checked_only',
+            action='store_true', default=False,
+            help='Only train on comments checked by humans'),
+        make_option('--min-count', dest='min_count', type='int', default=2,
+            help='Drop words seen fewer times than this'),
+        make_option('--min-examples', dest='min_examples', type='int',
+            default=100, help='The minimum number of spam and ham examples '
+            'before the classifier makes any decisions'),
+        make_option('--batch-size', dest='batch_size', type='int',
+            default=1000),
+    )
+
+    def handle(self, *args, **options):
+        if not options['output']:
+            raise CommandError('Set TCC_SPAM_CLASSIFIER or use --output')
+        verbosity = int(options.get('verbosity', 1))
+
+        labelled = Comment.unfiltered.filter(spam_status__isnull=False)
+        if options['checked_only']:
+            labelled = labelled.filter(is_checked=True)
+        labelled = labelled.order_by('id').values_list(
+            'id', 'comment_raw', 'spam_status')
+
+        classifier = NaiveBayes(min_examples=options['min_examples'])
+        last_id = 0
+        while True:
+            batch = list(labelled.filter(id__gt=last_id)
+                [:options['batch_size']])
+            if not batch:
+                break
+            for id, comment_raw, spam_status in batch:
+                classifier.train(comment_raw, spam_status == SPAM)
+            last_id = batch[-1][0]
+            if verbosity > 1:
+                self.stdout.write('Trained on comments up to id %d\n'
+                    % last_id)
+
+        classifier.prune(options['min_count'])
+        classifier.save(options['output'])
+        if verbosity:
+            self.stdout.write('Trained on %d spam and %d ham comments, '
+                '%d words stored in %s\n' % (
+                    classifier.spam_count, classifier.ham_count,
+                    len(classifier.tokens), options['output']))
@@ -1,5 +1,13 @@
+from datetime import datetime
+import operator
+import time
+
+from django.core.cache import cache
 from django.db import models
-from tcc.utils import get_content_types, get_content_type_id
+from django.db.models.fields import FieldDoesNotExist
+from django.utils.translation import ugettext_lazy as _
+from tcc.utils import atomic, get_content_types, get_content_type_id
+from tcc import identity
 from tcc import settings
 from django.db.models.sql import compiler
 from entity.static import SPAM_STATUS_CHOICES
@@ -146,6 +154,25 @@ class CommentsQuerySet(models.query.QuerySet):
 
         return qs
 
+    def with_pending_replies(self):
+        ''' Selects the number of ReplyDeltas not folded into each comment
+        yet as `pending_replies` (TCC_COALESCE_REPLIES), so
+        `get_child_count()` doesn't count them one comment at a time '''
+        if not settings.COALESCE_REPLIES:
+            return self._clone()
+        from tcc.models import ReplyDelta
+        table = quote(self.model._meta.db_table)
+        return self.extra(select={'pending_replies':
+            'SELECT COUNT(*) FROM %s WHERE %s.%s = %s.%s' % (
+                quote(ReplyDelta._meta.db_table),
+                quote(ReplyDelta._meta.db_table),
+                quote(ReplyDelta._meta.get_field('parent').column),
+                table, quote(self.model._meta.pk.column))})
+
+    def chunked(self, chunk_size=settings.STREAM_CHUNK_SIZE):
+        return self._clone(klass=ChunkedCommentsQuerySet,
+            chunk_size=chunk_size)
+
     def _clone(self, klass=None, setup=False, **kwargs):
         if klass is None:
             klass = CommentsQuerySet
@@ -153,25 +180,152 @@ class CommentsQuerySet(models.query.QuerySet):
         return super(CommentsQuerySet, self)._clone(klass=klass,
             setup=setup, **kwargs)
 
-    def mark_as_spam(self, send_to_akismet=True):
-        data = {'spam_status': SPAM_STATUS_CHOICES.dict.get('Spam'),
-                'is_checked': True,
-                'is_removed': True}
-        self.exclude(**data).update(**data)
+    def _mark(self, kind, data):
+        ''' Updates the comments that differ from `data`, recording a `kind`
+        event for each of them '''
+        from tcc.models import CommentEvent, Subscription
+        with atomic():
+            changed = list(self.exclude(**data).only(
+                'id', 'content_type', 'object_pk'))
+            ids = [c.id for c in changed]
+            if not ids:
+                return
+            self.model.unfiltered.filter(id__in=ids).update(**data)
+            identity.discard(ids)
+            CommentEvent.objects.record(kind, changed)
+            Subscription.objects.sync_visibility(ids)
 
+    def mark_as_spam(self, send_to_akismet=True):
+        from tcc.models import CommentEvent
+        self._mark(CommentEvent.SPAM, {
+            'spam_status': SPAM_STATUS_CHOICES.dict.get('Spam'),
+            'is_checked': True,
+            'is_removed': True})
+
+        from tcc import spam
+        comments = self.all().select_related('user')
+        spam.remember_verdicts(comments, True)
         if send_to_akismet:
-            for comment in self.all():
-                comment.submit_spam()
+            spam.submit_many('submit_spam', comments)
 
     def mark_as_ham(self, send_to_akismet=True):
-        data = {'spam_status': SPAM_STATUS_CHOICES.dict.get('Ham'),
-                'is_checked': True,
-                'is_removed': False}
-        self.exclude(**data).update(**data)
-
+        from tcc.models import CommentEvent
+        self._mark(CommentEvent.HAM, {
+            'spam_status': SPAM_STATUS_CHOICES.dict.get('Ham'),
+            'is_checked': True,
+            'is_removed': False})
+
+        from tcc import spam
+        comments = self.all().select_related('user')
+        spam.remember_verdicts(comments, False)
         if send_to_akismet:
-            for comment in self.all():
-                comment.submit_ham()
+            spam.submit_many('submit_ham', comments)
+
+
+class ChunkedCommentsQuerySet(CommentsQuerySet):
+    '''
+    Queryset which fetches its rows in chunks of `chunk_size` (by key, see
+    `_iter_chunks`) while being iterated and doesn't keep a result cache, so
+    memory stays flat and the (streaming) renderer can start before all rows
+    are fetched.
+
+    `len()` and `bool()` are answered with COUNT / EXISTS queries to keep
+    Jinja's `loop.last` and `if not comments` from consuming the rows.
+    '''
+    chunk_size = settings.STREAM_CHUNK_SIZE
+
+    def _is_sliced(self):
+        return bool(self.query.low_mark or self.query.high_mark is not None)
+
+    def __iter__(self):
+        if self._result_cache is not None or self._is_sliced():
+            return super(ChunkedCommentsQuerySet, self).__iter__()
+        return self._iter_chunks()
+
+    def _get_keys(self):
+        ''' The (field name, descending) ordering columns up to a unique
+        one, None if the rows can't be paged by key (ordered by a relation,
+        a nullable column or something else than a field) '''
+        meta = self.query.model._meta
+        keys = []
+        for name in self.query.order_by or meta.ordering:
+            descending = name.startswith('-')
+            name = name.lstrip('-')
+            if name == 'pk':
+                name = meta.pk.name
+            try:
+                field = meta.get_field(name)
+            except FieldDoesNotExist:
+                return None
+            if field.rel or field.null:
+                return None
+            keys.append((name, descending))
+            if field.primary_key:
+                return keys
+  # make sure the chunks don't overlap
+        return keys + [(meta.pk.name, False)]
+
+    def _iter_chunks(self):
+        ''' Fetches the chunks by key (after the last row of the previous
+        chunk), so comments posted while streaming don't shift them '''
+        keys = self._get_keys()
+        if keys is None:
+            for object_ in self._iter_offset_chunks():
+                yield object_
+            return
+
+        qs = self.order_by(*[(descending and '-' or '') + name
+                             for name, descending in keys])
+        chunk = list(qs[:self.chunk_size])
+        while True:
+            for object_ in chunk:
+                yield object_
+            if len(chunk) < self.chunk_size:
+                break
+            last = chunk[-1]
+            after = []
+            for i, (name, descending) in enumerate(keys):
+                q = dict((n, getattr(last, n)) for n, d in keys[:i])
+                q[name + (descending and '__lt' or '__gt')] = getattr(last,
+                                                                      name)
+                after.append(models.Q(**q))
+            chunk = list(qs.filter(reduce(operator.or_, after))
+                [:self.chunk_size])
+
+    def _iter_offset_chunks(self):
+        qs = self
+        ordering = list(self.query.order_by
+            or self.query.model._meta.ordering)
+        if not set(['id', '-id', 'pk', '-pk']).intersection(ordering):
+  # make sure the slices don't overlap
+            qs = self.order_by(*(ordering + ['id']))
+
+        offset = 0
+        while True:
+            chunk = list(qs[offset:offset + self.chunk_size])
+            for object_ in chunk:
+                yield object_
+            if len(chunk) < self.chunk_size:
+                break
+            offset += self.chunk_size
+
+    def __len__(self):
+        if self._result_cache is not None or self._is_sliced():
+            return super(ChunkedCommentsQuerySet, self).__len__()
+        return self.count()
+
+    def __nonzero__(self):
+        if self._result_cache is not None or self._is_sliced():
+            return super(ChunkedCommentsQuerySet, self).__nonzero__()
+        return self.exists()
+
+    def _clone(self, klass=None, setup=False, **kwargs):
+        if klass is None:
+            klass = ChunkedCommentsQuerySet
+        kwargs.setdefault('chunk_size', self.chunk_size)
+
+        return super(ChunkedCommentsQuerySet, self)._clone(klass=klass,
+            setup=setup, **kwargs)
 
 
 class CommentManager(models.Manager):
@@ -220,6 +374,11 @@ class CurrentCommentManager(CommentManager):
             content_type__id__in=get_content_types(),
         )
 
+    def is_current(self, comment):
+        ''' Whether the (already loaded) comment passes the filter above '''
+        return (comment.is_approved and comment.is_public
+                and comment.content_type_id in get_content_types())
+
 
 class LimitedCurrentCommentManager(CurrentCommentManager):
 
@@ -253,22 +412,259 @@ class DisapprovedCommentManager(models.Manager):
 
 class SubscriptionManager(models.Manager):
     def visible(self, user):
-        qs = self.get_query_set()
-
-        qs = (qs
-            .order_by('-comment__sort_date')
-            .filter(user=user)
-        )
-
-        qs = (
-            qs.filter(
-                comment__spam_status__isnull=False,
-                comment__is_removed=False,
-            )
-            | qs.filter(
-                comment__user=user
-            )
-        )
-
-        return qs
-
+        return (self.filter(user=user, visible=True)
+            .order_by('-sort_date', '-comment'))
+
+    def all_visible(self):
+        ''' The subscriptions `visible()` would return, for all users '''
+        return self.filter(visible=True)
+
+    def sync_visibility(self, comment_ids, counters=True):
+        ''' Updates `visible` of the subscriptions to the (root) comments
+        after their spam_status or is_removed changed, and the counters of
+        the users whose inbox changed '''
+        from tcc.models import Comment, SubscriptionCounter
+        subscriptions = self.filter(comment__in=comment_ids)
+        shown = Comment.unfiltered.filter(id__in=comment_ids,
+            spam_status__isnull=False, is_removed=False)
+        show = subscriptions.filter(visible=False).filter(
+            models.Q(comment__in=shown)
+            | models.Q(user=models.F('comment__user')))
+        hide = subscriptions.filter(visible=True).exclude(
+            comment__in=shown).exclude(user=models.F('comment__user'))
+
+        user_ids = set()
+        for qs, visible in ((show, True), (hide, False)):
+            ids = list(qs.values_list('id', 'user_id'))
+            if ids:
+                self.filter(id__in=[id for id, user_id in ids]).update(
+                    visible=visible)
+                user_ids.update(user_id for id, user_id in ids)
+        if counters and user_ids:
+            SubscriptionCounter.objects.rebuild(user_ids)
+
+    def sync_sort_dates(self, comment_ids):
+        from tcc.models import Comment
+        for id, sort_date in Comment.unfiltered.filter(
+                id__in=comment_ids).values_list('id', 'sort_date'):
+            self.filter(comment=id).exclude(sort_date=sort_date).update(
+                sort_date=sort_date)
+
+    def inbox_page(self, user, after=None, per_page=20, content_type_id=None):
+        ''' A page of `visible()` starting after the (sort_date, comment_id)
+        pair `after`, using the (user, visible, sort_date, comment) index,
+        optionally only the threads on `content_type_id` '''
+        qs = self.visible(user)
+        if content_type_id:
+            qs = qs.filter(comment__content_type=content_type_id)
+        if after:
+            sort_date, comment_id = after
+            qs = qs.filter(models.Q(sort_date__lt=sort_date)
+                | models.Q(sort_date=sort_date, comment__lt=comment_id))
+        return qs[:per_page]
+
+    def mark_read(self, user_id, comment_ids=None, read_at=None):
+        ''' Marks the subscriptions of the user to `comment_ids` (or all of
+        them) read with a single UPDATE, returns the number marked
+
+        With `read_at` (a buffered read marker) threads with replies after
+        it are left unread.
+        '''
+        from tcc.models import SubscriptionCounter
+        unread = self.filter(user=user_id, read_at__isnull=True)
+        if comment_ids is not None:
+            unread = unread.filter(comment__in=comment_ids)
+        if read_at is None:
+            read_at = datetime.now()
+        else:
+            unread = unread.filter(sort_date__lte=read_at)
+
+        with atomic():
+            if comment_ids is None:
+                marked = unread.update(read_at=read_at)
+                SubscriptionCounter.objects.filter(user=user_id).update(
+                    unread=0)
+            else:
+                visible = unread.filter(visible=True).count()
+                marked = unread.update(read_at=read_at)
+                SubscriptionCounter.objects.adjust([user_id],
+                    unread=-visible)
+        return marked
+
+    def reply_posted(self, reply):
+        ''' Moves the thread up and marks it unread for the other
+        subscribers, updating their counters '''
+        from tcc.models import SubscriptionCounter
+        thread = self.filter(comment=reply.parent_id)
+        rows = list(thread.values_list('user_id', 'read_at', 'visible'))
+        if not rows:
+            return
+        thread.update(sort_date=reply.submit_date)
+        read = set(user_id for user_id, read_at, visible in rows
+                   if read_at and user_id != reply.user_id)
+        if read:
+            thread.filter(user__in=read).update(read_at=None)
+
+        visible = set(user_id for user_id, read_at, v in rows if v)
+        SubscriptionCounter.objects.adjust(visible & read, unread=1,
+            last_activity=reply.submit_date)
+        SubscriptionCounter.objects.adjust(visible - read,
+            last_activity=reply.submit_date)
+
+
+class SubscriptionCounterManager(models.Manager):
+    def adjust(self, user_ids, total=0, unread=0, last_activity=None):
+        ''' Adds `total` and `unread` to the counters of the users, the
+        missing counters are rebuilt instead '''
+        user_ids = list(user_ids)
+        if not user_ids:
+            return
+        data = {}
+        if total:
+            data['total'] = models.F('total') + total
+        if unread:
+            data['unread'] = models.F('unread') + unread
+        if last_activity:
+            data['last_activity'] = last_activity
+        counters = self.filter(user__in=user_ids)
+        if data and counters.update(**data) == len(user_ids):
+            return
+        existing = set(counters.values_list('user_id', flat=True))
+        missing = [id for id in user_ids if id not in existing]
+        if missing:
+            self.rebuild(missing)
+
+    def rebuild(self, user_ids):
+        ''' Recounts the visible subscriptions of the users '''
+        from tcc.models import Subscription
+        visible = Subscription.objects.all_visible().filter(
+            user__in=user_ids).order_by().values('user')
+        counters = dict((user_id, self.model(user_id=user_id))
+                        for user_id in user_ids)
+        for row in visible.annotate(total=models.Count('id'),
+                last_activity=models.Max('sort_date')):
+            counters[row['user']].total = row['total']
+            counters[row['user']].last_activity = row['last_activity']
+        for row in visible.filter(read_at__isnull=True).annotate(
+                unread=models.Count('id')):
+            counters[row['user']].unread = row['unread']
+
+        with atomic():
+            self.filter(user__in=user_ids).delete()
+            self.bulk_create(counters.values())
+
+    def get_for_user(self, user_id):
+        try:
+            return self.get(user=user_id)
+        except self.model.DoesNotExist:
+            self.rebuild([user_id])
+            return self.get(user=user_id)
+
+
+class ThreadParticipantManager(models.Manager):
+    def add(self, root_id, user_id):
+        ''' Adds the user to the participants of the thread '''
+        return self.get_or_create(root_id=root_id, user_id=user_id)[0]
+
+    def remove(self, root_id, user_id):
+        self.filter(root=root_id, user=user_id).delete()
+
+    def user_ids(self, root_id):
+        return self.filter(root=root_id).values_list('user_id', flat=True)
+
+
+class CommentEventManager(models.Manager):
+    def record(self, kind, comments):
+        ''' Adds a `kind` event for each of the comments (when
+        TCC_EVENT_OUTBOX is enabled) '''
+        if settings.EVENT_OUTBOX and comments:
+            self.bulk_create([self.model(
+                kind=kind,
+                comment_id=c.id,
+                content_type_id=c.content_type_id,
+                object_pk=c.object_pk,
+            ) for c in comments])
+
+
+class ReplyDeltaManager(models.Manager):
+    INDEX_KEY = 'tcc:replies:%d'
+    SEED_LOCK_KEY = 'tcc:replies:%d:lock'
+
+    def _seed_index(self, parent_id):
+        ''' (Re)loads the highest index of the replies into the cache, one
+        process at a time '''
+        from tcc.models import Comment
+        key = self.INDEX_KEY % parent_id
+        lock = self.SEED_LOCK_KEY % parent_id
+        while cache.get(key) is None:
+            if not cache.add(lock, True, 10):
+                time.sleep(0.01)
+                continue
+            try:
+                indices = Comment.unfiltered.filter(
+                    parent=parent_id).aggregate(index=models.Max('index'))
+                cache.add(key, indices['index'] or 0, 24 * 3600)
+            finally:
+                cache.delete(lock)
+
+    def _incr_index(self, parent_id):
+        while True:
+            self._seed_index(parent_id)
+            try:
+                return cache.incr(self.INDEX_KEY % parent_id)
+            except ValueError:
+  # evicted since it was seeded
+                pass
+
+    def next_index(self, parent_id):
+        ''' Hands out the index of a new reply with an atomic cache incr,
+        raising ReplyNotAllowed beyond MAX_REPLIES
+
+        The indices of failed inserts are only handed out again after a
+        reseed (see `reset_index`), so the limit is checked once more
+        against the database before a reply is refused.
+        '''
+        from tcc.models import Comment, ReplyNotAllowed
+        index = self._incr_index(parent_id)
+        if index > Comment.MAX_REPLIES:
+            self.reset_index(parent_id)
+            index = self._incr_index(parent_id)
+            if index > Comment.MAX_REPLIES:
+                raise ReplyNotAllowed(_('Maximum number of replies reached'))
+        return index
+
+    def reset_index(self, parent_id):
+        cache.delete(self.INDEX_KEY % parent_id)
+
+    def fold(self, parent_ids=None, parents=None):
+        ''' Adds the pending deltas (of the parents, by id or a Q on
+        Comment) to child_count and sort_date, returns the number folded '''
+        from tcc.models import Comment
+        deltas = self.all()
+        if parent_ids is not None:
+            deltas = deltas.filter(parent__in=parent_ids)
+        if parents is not None:
+            deltas = deltas.filter(
+                parent__in=Comment.unfiltered.filter(parents).values('id'))
+
+        with atomic():
+  # locked, so concurrent folds can't count the same rows twice
+            rows = list(deltas.select_for_update().values_list(
+                'id', 'parent_id', 'submit_date'))
+            if not rows:
+                return 0
+
+            folded = {}
+            for id, parent_id, submit_date in rows:
+                count, last = folded.get(parent_id, (0, submit_date))
+                folded[parent_id] = (count + 1, max(last, submit_date))
+
+            for parent_id, (count, last) in folded.items():
+                Comment.unfiltered.filter(id=parent_id).update(
+                    child_count=models.F('child_count') + count)
+                Comment.unfiltered.filter(id=parent_id,
+                    sort_date__lt=last).update(sort_date=last)
+  # only the rows read above, newer ones are folded next time
+            self.filter(id__in=[row[0] for row in rows]).delete()
+        identity.discard(folded.keys())
+        return len(rows)
@@ -0,0 +1,39 @@
+from tcc import dispatch
+from tcc import identity
+
+
+class DeferredSignalMiddleware(object):
+    '''
+    Queues the deferred comment signals (see tcc.dispatch) during the request
+    and delivers them when it succeeded.
+
+    Must be listed *before* TransactionMiddleware, so the events are only
+    handed over once the transaction is committed.
+    '''
+
+    def process_request(self, request):
+        dispatch.begin()
+
+    def process_exception(self, request, exception):
+        dispatch.discard()
+
+    def process_response(self, request, response):
+        if response.status_code >= 500:
+            dispatch.discard()
+        else:
+            dispatch.commit()
+        return response
+
+
+class IdentityMapMiddleware(object):
+    ''' Loads every comment at most once per request, see tcc.identity '''
+
+    def process_request(self, request):
+        identity.begin()
+
+    def process_exception(self, request, exception):
+        identity.end()
+
+    def process_response(self, request, response):
+        identity.end()
+        return response
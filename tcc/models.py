@@ -6,29 +6,36 @@ from django.contrib.contenttypes import generic
 from django.contrib.contenttypes.models import ContentType
 from django.core.exceptions import ValidationError
 from django.core.urlresolvers import reverse, get_callable
-from django.db import models
+from django.db import IntegrityError, models, transaction
 from django.template.defaultfilters import striptags
 from django.utils.http import int_to_base36
 from django.utils.translation import ugettext_lazy as _
 
 from entity.static import SPAM_STATUS_CHOICES
 
+from tcc import identity
 from tcc import managers
 from tcc import signals
 from tcc import utils
 from tcc import settings as tcc_settings
 from django.utils.safestring import mark_safe
-from akismet import Akismet
 
 SITE_ID = getattr(settings, 'SITE_ID', 1)
 
 TWO_MINS = timedelta(minutes=2)
 
 
+class ReplyNotAllowed(ValidationError):
+    ''' The parent is closed, too deep or has MAX_REPLIES replies '''
+
+
 class Subscription(models.Model):
     user = models.ForeignKey(settings.AUTH_USER_MODEL)
     comment = models.ForeignKey('Comment')
     read_at = models.DateTimeField(null=True, blank=True, db_index=True)
+  # copies of the thread's sort_date and `is_visible()` for the inbox
+    sort_date = models.DateTimeField(null=True, blank=True)
+    visible = models.BooleanField(default=False)
 
     objects = managers.SubscriptionManager()
 
@@ -36,20 +43,140 @@ class Subscription(models.Model):
     def read(self):
         return bool(self.read_at)
 
+    def __init__(self, *args, **kwargs):
+        super(Subscription, self).__init__(*args, **kwargs)
+  # the stored state, to keep the SubscriptionCounter in sync
+        self._unread = self.unread
+
     @property
     def unread(self):
         return not self.read
 
+    def is_visible(self):
+        ''' whether it shows up in the inbox (stored as `visible`) '''
+        return (self.user_id == self.comment.user_id
+            or (self.comment.spam_status is not None
+                and not self.comment.is_removed))
+
     def save(self, *args, **kwargs):
-        if self.user_id == self.comment.user_id:
-            self.read_at = self.comment.submit_date or datetime.datetime.now()
+        is_new = not self.pk
+  # the comment is only needed for new subscriptions
+        if is_new:
+            if self.user_id == self.comment.user_id:
+                self.read_at = self.comment.submit_date or datetime.now()
+            self.sort_date = self.comment.sort_date
+            self.visible = self.is_visible()
 
-        return models.Model.save(self, *args, **kwargs)
+        result = models.Model.save(self, *args, **kwargs)
+
+        if is_new:
+            if self.visible:
+                SubscriptionCounter.objects.adjust([self.user_id], total=1,
+                    unread=int(self.unread), last_activity=self.sort_date)
+  # subscribers are notified like participants, as tcc_rebuild_participants
+  # has it
+            root_id = self.comment.parent_id or self.comment_id
+            if not Comment.unsubscribers.through.objects.filter(
+                    comment=root_id, user=self.user_id).exists():
+                ThreadParticipant.objects.add(root_id, self.user_id)
+        elif self.unread != self._unread and self.visible:
+            SubscriptionCounter.objects.adjust([self.user_id],
+                unread=self.unread and 1 or -1)
+        self._unread = self.unread
+        return result
+
+    def delete(self, *args, **kwargs):
+        super(Subscription, self).delete(*args, **kwargs)
+        if self.visible:
+            SubscriptionCounter.objects.adjust([self.user_id], total=-1,
+                unread=-int(self._unread))
 
     class Meta:
         unique_together = (
             ('user', 'comment'),
         )
+        index_together = (
+            ('user', 'visible', 'sort_date', 'comment'),
+            ('comment', 'user'),
+        )
+
+
+class SubscriptionCounter(models.Model):
+    ''' The inbox counts of a user: the visible subscriptions, the unread
+    ones and the latest activity in any of them
+
+    Kept up to date on subscribe, read, reply and moderation of the thread,
+    `tcc_rebuild_inbox` recounts.
+    '''
+    user = models.OneToOneField(settings.AUTH_USER_MODEL, primary_key=True,
+        related_name='tcc_subscription_counter')
+    total = models.IntegerField(default=0)
+    unread = models.IntegerField(default=0)
+    last_activity = models.DateTimeField(null=True, blank=True)
+
+    objects = managers.SubscriptionCounterManager()
+
+
+class ReplyDelta(models.Model):
+    ''' A reply that isn't counted in the child_count / sort_date of its
+    parent yet (TCC_COALESCE_REPLIES)
+
+    Appending these instead of updating the parent keeps repliers to a hot
+    thread from queueing on its row lock. They're folded into the parent by
+    `tcc_fold_replies`, reads never write; `get_child_count()` adds the
+    pending ones, which the api's listings select along with the comments.
+    '''
+    parent = models.ForeignKey('Comment', related_name='reply_deltas')
+    submit_date = models.DateTimeField()
+
+    objects = managers.ReplyDeltaManager()
+
+
+class ThreadParticipant(models.Model):
+    ''' The users receiving notifications for a thread: everyone that posted
+    in it or subscribed to it, minus the unsubscribers '''
+    root = models.ForeignKey('Comment', related_name='participants')
+    user = models.ForeignKey(settings.AUTH_USER_MODEL)
+
+    objects = managers.ThreadParticipantManager()
+
+    class Meta:
+        unique_together = (
+            ('root', 'user'),
+        )
+
+
+class CommentEvent(models.Model):
+    ''' Outbox row, written in the same transaction as the change to the
+    comment and read by the `tcc_consume_events` command '''
+    POSTED, REMOVED, RESTORED, APPROVED, DISAPPROVED, SPAM, HAM, FLAGGED, \
+        DELETED = range(1, 10)
+    KIND_CHOICES = (
+        (POSTED, 'posted'),
+        (REMOVED, 'removed'),
+        (RESTORED, 'restored'),
+        (APPROVED, 'approved'),
+        (DISAPPROVED, 'disapproved'),
+        (SPAM, 'spam'),
+        (HAM, 'ham'),
+        (FLAGGED, 'flagged'),
+        (DELETED, 'deleted'),
+    )
+
+  # no foreign keys, the events outlive deleted comments
+    comment_id = models.IntegerField()
+    content_type_id = models.IntegerField()
+    object_pk = models.IntegerField()
+    kind = models.PositiveSmallIntegerField(choices=KIND_CHOICES)
+    created_at = models.DateTimeField(default=datetime.now)
+
+    objects = managers.CommentEventManager()
+
+
+class EventCursor(models.Model):
+    ''' The id of the last CommentEvent handled by a consumer '''
+    name = models.CharField(max_length=100, unique=True)
+    last_id = models.IntegerField(default=0)
 
 
 class Comment(models.Model):
@@ -61,6 +188,8 @@ class Comment(models.Model):
   # constants
 
     MAX_REPLIES = tcc_settings.MAX_REPLIES
+  # tries to insert a coalesced reply with a free index
+    INDEX_ATTEMPTS = 3
     REPLY_LIMIT = tcc_settings.REPLY_LIMIT
 
   # From comments BaseCommentAbstractModel
@@ -91,6 +220,8 @@ class Comment(models.Model):
         max_length=tcc_settings.COMMENT_MAX_LENGTH)
     comment_raw = models.TextField(_('Raw Comment'),
         max_length=tcc_settings.COMMENT_MAX_LENGTH)
+    parser_version = models.IntegerField(_('Parser version'), default=0,
+        db_index=True)
 
   # still accepting replies?
     is_open = models.BooleanField(_('Open'), default=True)
@@ -141,22 +272,45 @@ class Comment(models.Model):
         unique_together = (
             ('content_type', 'object_pk', 'parent', 'index'),
         )
+        index_together = (
+            ('user', 'submit_date', 'id'),
+        )
 
     def get_subscribers(self):
-        # get all related comments
-        comments = self.get_comments_in_thread()
-        # get at most `MAX_REPLIES` and the parent thread
-        comments = comments[:tcc_settings.MAX_REPLIES+1]
-        # append the user ids to the list of user_ids
-        return comments.values_list('user_id', flat=True)
-
-    def get_parsed_comment(self, reparse=settings.DEBUG):
-        if reparse:
-            signals.comment_will_be_posted.send(
-                sender = self.__class__, comment = self)
-        parsed_comment = self.comment
-        safe_comment = mark_safe(parsed_comment)
-        return safe_comment
+        ''' the ids of the users to notify about this comment '''
+        return ThreadParticipant.objects.user_ids(self.parent_id or self.id)
+
+    def add_participant(self):
+        ''' adds the author to the participants of the thread, unless
+        (s)he unsubscribed from it '''
+        if not tcc_settings.SUBSCRIBE_ON_POST:
+            return
+        root_id = self.parent_id or self.id
+        if self.parent_id and Comment.unsubscribers.through.objects.filter(
+                comment=root_id, user=self.user_id).exists():
+            return
+        ThreadParticipant.objects.add(root_id, self.user_id)
+
+    def get_parsed_comment(self):
+        ''' returns the stored parsed comment
+
+        Parsing only happens on save and through the `tcc_reparse`
+        management command, never while displaying a comment.
+        '''
+        return mark_safe(self.comment)
+
+    def parse(self):
+        ''' (re)parse the comment by running the `comment_will_be_posted`
+        receivers and stamp it with the current parser version
+
+        Returns the (receiver, response) pairs of the signal.
+        '''
+  # receivers may read either field, so they always start from the raw text
+        self.comment = self.comment_raw
+        responses = signals.comment_will_be_posted.send(
+            sender = self.__class__, comment = self)
+        self.parser_version = tcc_settings.PARSER_VERSION
+        return responses
 
     def __repr__(self):
         return (u'<%s[%d]: at %s by %s: %r>' % (
@@ -179,10 +333,7 @@ class Comment(models.Model):
         })
 
     def clean(self):
-        if self.parent:
-            if not self.pk and self.parent.child_count >= self.MAX_REPLIES:
-                raise ValidationError(_('Maximum number of replies reached'))
-
+  # MAX_REPLIES and is_open of the parent are enforced by save()
         comment = self.comment_raw or self.comment
         if striptags(comment).strip() == '':
             raise ValidationError(_("This field is required."))
@@ -214,7 +365,7 @@ class Comment(models.Model):
             replies = Comment.objects.filter(parent=self)
             if levels:
   # 'z' is the highest value in base36 (as implemented in django)
-                replies = replies.filter(index__gte=self.child_count-tcc_settings.REPLY_LIMIT)
+                replies = replies.filter(index__gte=self.get_child_count()-tcc_settings.REPLY_LIMIT)
 
             if not include_self:
                 replies = replies.exclude(id=self.id)
@@ -244,7 +395,9 @@ class Comment(models.Model):
         '''save the comment and add the index, update the parent child count
 
         simple -- only save, don't do any magic
+        event -- the CommentEvent kind to record along with the change
         '''
+        event = kwargs.pop('event', None)
         if simple:
             super(Comment, self).save(*args, **kwargs)
             return
@@ -258,8 +411,7 @@ class Comment(models.Model):
             if self.comment_raw is None or self.comment_raw == '':
                 self.comment_raw = self.comment
 
-            responses = signals.comment_will_be_posted.send(
-                sender = self.__class__, comment = self)
+            responses = self.parse()
 
             # only save the comment if none of the signals return False
             for (receiver, response) in responses:
@@ -269,46 +421,149 @@ class Comment(models.Model):
 
         self.clean()
 
-        # Find the comment index to use
         if is_new:
-            comments = self.get_related_comments()
-
-            if self.parent_id:
-                parents = comments.filter(id=self.parent_id)
-                parents.update(
-                    child_count=models.F('child_count') + 1,
-                    sort_date=self.submit_date,
-                )
-                self.index = parents.values_list('child_count', flat=True)[0]
-
-            else:
-                comments = comments.order_by('-index')
-                indices = list(comments.values_list('index', flat=True)[:1])
-                if indices:
-                    self.index = indices[0] + 1
-                else:
-                    self.index = 1
-
-        super(Comment, self).save(*args, **kwargs)
+            event = CommentEvent.POSTED
+        if event and tcc_settings.EVENT_OUTBOX:
+            with utils.atomic():
+                self._save_in_thread(is_new, *args, **kwargs)
+                CommentEvent.objects.record(event, [self])
+        else:
+            self._save_in_thread(is_new, *args, **kwargs)
 
         # We should have an ID by now
         assert self.id
 
         if is_new:
+            self.add_participant()
+            if self.parent_id:
+                Subscription.objects.reply_posted(self)
+
             # Sending this signal so *it* can be handled rather than
             # post_save which is triggered 'too soon': before
             # self.path is saved.  If there is an exception in a
             # post_save handler the path is never set and the database
             # will refuse to save another comment which is quite bad
             # for a commenting system.
-            responses = signals.comment_was_posted.send(
-                sender  = self.__class__, comment = self)
+            # With TCC_DEFERRED_SIGNALS it's delivered after the commit.
+            from tcc import dispatch
+            dispatch.send(signals.comment_was_posted,
+                sender = self.__class__, comment = self)
+
+            if tcc_settings.SPAM_CHECK_ON_POST:
+                from tcc import spam
+                dispatch.after_commit(spam.enqueue_check, [self.id])
+
+        elif not self.parent_id:
+  # spam_status or is_removed may have changed
+            Subscription.objects.sync_visibility([self.id])
+
+    def _save_in_thread(self, is_new, *args, **kwargs):
+  # the spot claimed on the parent is given back if the insert fails
+        with utils.atomic():
+            # Find the comment index to use
+            if is_new:
+                comments = self.get_related_comments()
+
+                if self.parent_id:
+                    parents = comments.filter(id=self.parent_id, is_open=True)
+  # the parent's depth < MAX_DEPTH - 1: no ancestor MAX_DEPTH - 1 levels up
+                    if tcc_settings.MAX_DEPTH < 2:
+                        parents = parents.none()
+                    else:
+                        parents = parents.filter(**{'__'.join(
+                            ['parent'] * (tcc_settings.MAX_DEPTH - 1)) +
+                            '__isnull': True})
+
+                if self.parent_id and tcc_settings.COALESCE_REPLIES:
+  # no lock on the parent row, see ReplyDelta
+                    if not parents.exists():
+                        raise ReplyNotAllowed(_('Replies are not allowed'))
+
+                elif self.parent_id:
+  # checks and claims a spot in one statement, so concurrent replies can't
+  # exceed MAX_REPLIES or slip in after the parent was closed
+                    updated = parents.filter(
+                        child_count__lt=self.MAX_REPLIES,
+                    ).update(
+                        child_count=models.F('child_count') + 1,
+                        sort_date=self.submit_date,
+                    )
+                    if not updated:
+                        if parents.exists():
+                            raise ReplyNotAllowed(
+                                _('Maximum number of replies reached'))
+                        raise ReplyNotAllowed(_('Replies are not allowed'))
+  # the parent row is locked by the update, read it however it's filtered
+                    self.index = Comment.unfiltered.filter(
+                        id=self.parent_id).values_list(
+                        'child_count', flat=True)[0]
+
+                else:
+                    comments = comments.order_by('-index')
+                    indices = list(
+                        comments.values_list('index', flat=True)[:1])
+                    if indices:
+                        self.index = indices[0] + 1
+                    else:
+                        self.index = 1
+
+            if is_new and self.parent_id and tcc_settings.COALESCE_REPLIES:
+                self._save_coalesced_reply(*args, **kwargs)
+                ReplyDelta.objects.create(parent_id=self.parent_id,
+                                          submit_date=self.submit_date)
+            else:
+                super(Comment, self).save(*args, **kwargs)
+                if is_new and self.parent_id:
+                    identity.update(self.parent_id, child_count=self.index,
+                                    sort_date=self.submit_date)
+            if is_new:
+                identity.add(self)
+
+    def _save_coalesced_reply(self, *args, **kwargs):
+        ''' Inserts the reply with the next index from the cache. An index
+        taken already (the cache was reseeded before a concurrent reply
+        committed) is skipped, after any other failure the next reply
+        reseeds the index from the database. '''
+        for attempt in range(self.INDEX_ATTEMPTS):
+            self.index = ReplyDelta.objects.next_index(self.parent_id)
+            sid = transaction.savepoint()
+            try:
+                super(Comment, self).save(*args, **kwargs)
+            except IntegrityError:
+                transaction.savepoint_rollback(sid)
+                if attempt == self.INDEX_ATTEMPTS - 1:
+                    ReplyDelta.objects.reset_index(self.parent_id)
+                    raise
+            except:
+                transaction.savepoint_rollback(sid)
+                ReplyDelta.objects.reset_index(self.parent_id)
+                raise
+            else:
+                transaction.savepoint_commit(sid)
+                return
 
     def delete(self, *args, **kwargs):
+        if not tcc_settings.EVENT_OUTBOX:
+            self._delete_from_thread(*args, **kwargs)
+            return
+
+        with utils.atomic():
+            deleted = list(self.get_replies(include_self=True).only(
+                'id', 'content_type', 'object_pk'))
+            if self.id not in [c.id for c in deleted]:
+                deleted.append(self)
+            self._delete_from_thread(*args, **kwargs)
+            CommentEvent.objects.record(CommentEvent.DELETED, deleted)
+
+    def _delete_from_thread(self, *args, **kwargs):
+        identity.discard([self.id])
         self.get_replies(include_self=True).delete()
 
         super(Comment, self).delete(*args, **kwargs)
 
+        if self.parent_id and tcc_settings.COALESCE_REPLIES:
+            ReplyDelta.objects.reset_index(self.parent_id)
+
         if self.parent_id:
             comments = self.get_related_comments()
 
@@ -316,12 +571,17 @@ class Comment(models.Model):
                 child_count=models.F('child_count') - 1,
             )
 
-            comments.filter(
+            shifted = comments.filter(
                 parent=self.parent_id,
                 index__gt=self.index,
-            ).update(
+            )
+            if identity.active():
+                identity.discard(list(shifted.values_list('id', flat=True)))
+            shifted.update(
                 index=models.F('index') - 1,
             )
+  # reloaded with the new child_count on the next lookup
+            identity.discard([self.parent_id])
 
     def _set_limit(self):
         replies = self.get_replies(levels=1).order_by('-submit_date')
@@ -343,8 +603,19 @@ class Comment(models.Model):
 
     depth = property(get_depth)
 
+    def get_child_count(self):
+        ''' child_count plus the replies not folded into it yet
+        (TCC_COALESCE_REPLIES), selected along with the comment by
+        `with_pending_replies()` or counted here '''
+        if tcc_settings.COALESCE_REPLIES:
+            pending = getattr(self, 'pending_replies', None)
+            if pending is None:
+                pending = self.reply_deltas.count()
+            return self.child_count + pending
+        return self.child_count
+
     def reply_allowed(self):
-        return self.is_open and self.child_count < self.MAX_REPLIES \
+        return self.is_open and self.get_child_count() < self.MAX_REPLIES \
             and (self.depth < tcc_settings.MAX_DEPTH - 1 )
 
     def can_open(self, user):
@@ -402,8 +673,10 @@ class Comment(models.Model):
         self.spam_status = SPAM_STATUS_CHOICES.dict.get('Spam')
         self.is_checked = True
         self.is_removed = True
-        self.save()
+        self.save(event=CommentEvent.SPAM)
 
+        from tcc import spam
+        spam.remember_verdicts([self], True)
         if send_to_akismet:
             self.submit_spam()
 
@@ -411,58 +684,62 @@ class Comment(models.Model):
         self.spam_status = SPAM_STATUS_CHOICES.dict.get('Ham')
         self.is_checked = True
         self.is_removed = False
-        self.save()
-        
+        self.save(event=CommentEvent.HAM)
+
+        from tcc import spam
+        spam.remember_verdicts([self], False)
         if not self.email_sent_at:
             # Notification emails have not been sent yet, so send them now
-            from threaded_comments import tasks
-            tasks.send_comment_mails.delay(self)
+            self.send_notifications()
 
         if send_to_akismet:
             self.submit_ham()
 
+    def send_notifications(self):
+        if tcc_settings.NOTIFICATION_DIGEST:
+  # email_sent_at is still NULL so the next digest picks it up
+            return
+        from threaded_comments import tasks
+        tasks.send_comment_mails.delay(self)
+
     def _setup_akismet(self):
-        KEY = getattr(settings, 'AKISMET_KEY')
-        DOMAIN = getattr(settings, 'AKISMET_DOMAIN')
-        api = Akismet(agent='fash_spam_test')
-        api.setAPIKey(KEY, DOMAIN)
-        return api
-        
+        from tcc import spam
+        return spam.get_client()
+
 
     def submit_spam(self):
         """ Report a spam message to Akismet. """
-        api = self._setup_akismet()
-        if self.user.is_staff:
-            return
-        api.submit_spam(self.comment_raw, self.akismet_data())
-
+        from tcc import spam
+        spam.submit_many('submit_spam', [self])
 
     def submit_ham(self):
         """ Report a ham message to Akismet. """
-        api = self._setup_akismet()
-        if self.user.is_staff:
-            return
-        api.submit_ham(self.comment_raw, self.akismet_data())
+        from tcc import spam
+        spam.submit_many('submit_ham', [self])
 
     def check_comment(self):
         """ Submit the message to Akismet to see if it is ham or spam.
+
+        Returns None (and leaves the comment unchecked, to be checked again
+        later) if Akismet is unavailable.
         """
-        api = self._setup_akismet()
-        is_spam = api.comment_check(self.comment_raw,
-                                    self.akismet_data())
+        from tcc import spam
+        try:
+            is_spam = spam.comment_check(self)
+        except spam.AkismetError:
+            spam.defer_check([self.id])
+            return None
 
         if is_spam:
             self.spam_status = SPAM_STATUS_CHOICES.dict.get('Spam')
             self.is_removed = True
-            self.save()
+            self.save(event=CommentEvent.SPAM)
         else:
             self.spam_status = SPAM_STATUS_CHOICES.dict.get('Ham')
             self.is_removed = False
-            self.save()
+            self.save(event=CommentEvent.HAM)
             # Send an email to notify the user they have a new comment
-            from threaded_comments import tasks
-            tasks.send_comment_mails.delay(self)
-                
+            self.send_notifications()
 
         return is_spam
 
@@ -495,3 +772,5 @@ class SpamReport(models.Model):
     class Meta:
         unique_together = ['user', 'comment']
 
+
+Comment.parent = identity.ParentDescriptor(Comment._meta.get_field('parent'))
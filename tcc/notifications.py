@@ -0,0 +1,102 @@
+'''
+Notification digests.
+
+With TCC_NOTIFICATION_DIGEST enabled no mail is sent per comment. Instead
+`send_digests` (run periodically through the `tcc_send_digests` command)
+collects the ham comments which haven't been mailed yet (email_sent_at is
+NULL), sends every subscriber a single mail listing the new replies in their
+threads and marks the batch with email_sent_at.
+'''
+from datetime import datetime, timedelta
+
+from django.contrib.auth.models import User
+from django.contrib.sites.models import Site
+from django.core.mail import EmailMessage, get_connection
+
+from coffin.template.loader import render_to_string
+from entity.static import SPAM_STATUS_CHOICES
+
+from tcc.models import Comment, ThreadParticipant
+from tcc import settings as tcc_settings
+
+HAM = SPAM_STATUS_CHOICES.dict.get('Ham')
+
+
+def get_pending():
+    ''' The comments which still have to go out in a digest '''
+    max_age = timedelta(days=tcc_settings.NOTIFICATION_DIGEST_MAX_AGE)
+    return Comment.unfiltered.filter(
+        email_sent_at__isnull=True,
+        spam_status=HAM,
+        is_removed=False,
+        submit_date__gte=datetime.now() - max_age,
+    ).order_by('id')
+
+
+def get_thread_subscribers(root_ids):
+    ''' Maps the thread roots to the ids of their participants '''
+    subscribers = {}
+    participants = ThreadParticipant.objects.filter(root__in=root_ids)
+    for root_id, user_id in participants.values_list('root_id', 'user_id'):
+        subscribers.setdefault(root_id, set()).add(user_id)
+    return subscribers
+
+
+def _build_digests(comments):
+    ''' Returns {user_id: {root_id: [reply, ...]}} for the replies in
+    `comments`, a new thread has no subscribers but its author '''
+    replies = [c for c in comments if c.parent_id]
+    subscribers = get_thread_subscribers(set(c.parent_id for c in replies))
+    digests = {}
+    for comment in replies:
+        for user_id in subscribers.get(comment.parent_id, ()):
+            if user_id != comment.user_id:
+                (digests.setdefault(user_id, {})
+                    .setdefault(comment.parent_id, []).append(comment))
+    return digests
+
+
+def send_digests(batch_size=1000):
+    ''' Sends the digests for all pending comments over a single SMTP
+    connection. Returns the number of mails sent. '''
+    site = Site.objects.get_current()
+    connection = get_connection()
+    connection.open()
+    sent = 0
+    try:
+        while True:
+            comments = list(get_pending().select_related('user')
+                [:batch_size])
+            if not comments:
+                break
+
+            digests = _build_digests(comments)
+            users = User.objects.filter(id__in=digests.keys()).exclude(
+                email='').in_bulk(digests.keys())
+            roots = Comment.unfiltered.in_bulk(
+                set(c.parent_id for c in comments if c.parent_id))
+
+            messages = []
+            for user_id, threads in digests.items():
+                user = users.get(user_id)
+                if user is None:
+                    continue
+                context = {
+                    'user': user,
+                    'site': site,
+                    'threads': [(roots[root_id], replies)
+                                for root_id, replies in threads.items()],
+                    'count': sum(len(r) for r in threads.values()),
+                }
+                subject = render_to_string('tcc/digest_subject.txt', context)
+                body = render_to_string('tcc/digest_email.txt', context)
+                messages.append(EmailMessage(' '.join(subject.split()), body,
+                    to=[user.email], connection=connection))
+
+            if messages:
+                sent += connection.send_messages(messages) or 0
+            Comment.unfiltered.filter(id__in=[c.id for c in comments]
+                ).update(email_sent_at=datetime.now())
+    finally:
+        connection.close()
+    return sent
@@ -0,0 +1,47 @@
+'''
+Posting rate limits.
+
+TCC_RATE_LIMITS maps a scope ('user' or 'ip') to a list of (count, seconds)
+limits, e.g. {'user': [(5, 60), (100, 24 * 3600)], 'ip': [(20, 60)]}.
+Every post attempt is counted in the cache, per window, with a single
+atomic `incr`; an attempt beyond any of the limits is rejected. Rejected
+attempts count as well, so a flood stays blocked until its window ends.
+'''
+import time
+
+from django.core.cache import cache
+
+from tcc import settings as tcc_settings
+
+KEY = 'tcc:rate:%s:%s:%d:%d'
+
+
+def hit(scope, ident, limits):
+    ''' Counts an attempt, returns False if it exceeds one of the limits '''
+    now = int(time.time())
+    allowed = True
+    for count, seconds in limits:
+        key = KEY % (scope, ident, seconds, now // seconds)
+        try:
+            hits = cache.incr(key)
+        except ValueError:
+  # first attempt in this window (or it just expired)
+            if cache.add(key, 1, seconds):
+                hits = 1
+            else:
+                hits = cache.incr(key)
+        if hits > count:
+            allowed = False
+    return allowed
+
+
+def allow(user_id=None, ip=None):
+    ''' Counts a post attempt of the user / ip address, returns False if
+    it should be rejected '''
+    limits = tcc_settings.RATE_LIMITS
+    allowed = True
+    if user_id and limits.get('user'):
+        allowed = hit('user', user_id, limits['user']) and allowed
+    if ip and limits.get('ip'):
+        allowed = hit('ip', ip, limits['ip']) and allowed
+    return allowed
@@ -0,0 +1,158 @@
+'''
+Write-behind buffer for read markers.
+
+With TCC_READ_MARKER_BUFFER enabled, marking threads read doesn't touch the
+database. Each user has one cache key with {comment_id: read_at}, which
+`get_inbox` and `get_unread_count` merge so users see their own reads right
+away, and is added to a set of users with buffered markers (split over
+DIRTY_SHARDS keys). Both are changed under a short cache lock, so concurrent
+requests can't overwrite each other's markers.
+
+The `tcc_flush_read_markers` command writes the markers of those users back
+periodically, with one UPDATE per user and read time, and drops the written
+ones from the user's key. A user with more than TCC_READ_MARKER_MAX
+buffered markers has them written back right away.
+
+A buffered marker only applies to threads without replies after it, both
+when merging and when flushing. Markers the cache evicts before a flush are
+lost; the threads simply stay unread.
+'''
+from contextlib import contextmanager
+import time
+
+from django.core.cache import cache
+
+from tcc.models import Subscription
+from tcc import settings as tcc_settings
+
+LOCK_KEY = 'tcc:read:lock'
+OVERLAY_KEY = 'tcc:read:user:%d'
+DIRTY_KEY = 'tcc:read:dirty:%d'
+
+DIRTY_SHARDS = 16
+  # a lock left behind by a dead process is taken over after this long
+LOCK_TIMEOUT = 10
+
+
+@contextmanager
+def _locked(key):
+    lock = key + ':lock'
+    while not cache.add(lock, True, LOCK_TIMEOUT):
+        time.sleep(0.01)
+    try:
+        yield
+    finally:
+        cache.delete(lock)
+
+
+def _mark_dirty(user_id):
+    key = DIRTY_KEY % (user_id % DIRTY_SHARDS)
+    with _locked(key):
+        user_ids = cache.get(key) or set()
+        if user_id not in user_ids:
+            user_ids.add(user_id)
+            cache.set(key, user_ids, tcc_settings.READ_MARKER_TTL)
+
+
+def _write(user_id, overlay):
+    by_date = {}
+    for comment_id, read_at in overlay.items():
+        by_date.setdefault(read_at, []).append(comment_id)
+    for read_at, comment_ids in by_date.items():
+        Subscription.objects.mark_read(user_id, comment_ids, read_at=read_at)
+
+
+def mark_read(user_id, comment_ids, read_at):
+    ''' Buffers the read markers of the user for the threads '''
+    key = OVERLAY_KEY % user_id
+    with _locked(key):
+        overlay = cache.get(key) or {}
+        for comment_id in comment_ids:
+            overlay[comment_id] = max(overlay.get(comment_id, read_at),
+                                      read_at)
+        if len(overlay) > tcc_settings.READ_MARKER_MAX:
+            cache.delete(key)
+        else:
+            cache.set(key, overlay, tcc_settings.READ_MARKER_TTL)
+            overlay = None
+    if overlay:
+        _write(user_id, overlay)
+    else:
+  # after the markers, so a flush that finds the user sees them
+        _mark_dirty(user_id)
+
+
+def get_overlay(user_id):
+    ''' {comment_id: read_at} of the buffered markers of the user '''
+    return cache.get(OVERLAY_KEY % user_id) or {}
+
+
+def apply(user_id, subscriptions):
+    ''' Sets read_at of the (unread) subscriptions with a buffered marker '''
+    overlay = get_overlay(user_id)
+    if overlay:
+        for subscription in subscriptions:
+            read_at = overlay.get(subscription.comment_id)
+            if (subscription.read_at is None and read_at is not None
+                    and subscription.sort_date <= read_at):
+                subscription.read_at = read_at
+    return subscriptions
+
+
+def count_buffered_unread(user_id):
+    ''' The number of visible, unread subscriptions with a buffered marker,
+    to subtract from the unread counter '''
+    overlay = get_overlay(user_id)
+    if not overlay:
+        return 0
+    rows = Subscription.objects.filter(user=user_id, visible=True,
+        read_at__isnull=True, comment__in=overlay.keys()).values_list(
+        'comment_id', 'sort_date')
+    return len([comment_id for comment_id, sort_date in rows
+                if sort_date <= overlay[comment_id]])
+
+
+def _flush_user(user_id):
+    key = OVERLAY_KEY % user_id
+    overlay = get_overlay(user_id)
+    if not overlay:
+        return 0
+    _write(user_id, overlay)
+
+  # markers added (or moved on) since are left for the next flush
+    with _locked(key):
+        current = get_overlay(user_id)
+        for comment_id, read_at in overlay.items():
+            if current.get(comment_id) == read_at:
+                del current[comment_id]
+        if current:
+            cache.set(key, current, tcc_settings.READ_MARKER_TTL)
+        else:
+            cache.delete(key)
+    return len(overlay)
+
+
+def flush():
+    ''' Writes the buffered markers to the database, returns the number of
+    markers flushed (None if another flush is running) '''
+    if not cache.add(LOCK_KEY, True, 600):
+        return None
+    try:
+        total = 0
+        for shard in range(DIRTY_SHARDS):
+            key = DIRTY_KEY % shard
+            with _locked(key):
+                user_ids = cache.get(key) or set()
+                cache.delete(key)
+            pending = set(user_ids)
+            try:
+                for user_id in user_ids:
+                    total += _flush_user(user_id)
+                    pending.discard(user_id)
+            finally:
+  # the users that weren't flushed are put back
+                for user_id in pending:
+                    _mark_dirty(user_id)
+        return total
+    finally:
+        cache.delete(LOCK_KEY)
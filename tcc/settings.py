@@ -5,6 +5,12 @@ MAX_DEPTH = getattr(settings, 'TCC_MAX_DEPTH', 2)
 REPLY_LIMIT = getattr(settings, 'TCC_REPLY_LIMIT', 3)
 MAX_REPLIES = getattr(settings, 'TCC_MAX_REPLIES', 50)
 STEPLEN = getattr(settings, 'TCC_STEPLEN', 6)
+  # rendering
+STREAMING = getattr(settings, 'TCC_STREAMING', False)
+STREAM_CHUNK_SIZE = getattr(settings, 'TCC_STREAM_CHUNK_SIZE', 100)
+  # render the listing identically for every visitor (the per-user bits are
+  # fetched from the `tcc_user` view) so it can be cached by a shared cache
+SHARED_LISTING = getattr(settings, 'TCC_SHARED_LISTING', False)
   # paginator stuff
 PER_PAGE = getattr(settings, 'PER_PAGE', 25)
 PAGE_WINDOW = getattr(settings, 'PAGE_WINDOW', 3)
@@ -14,9 +20,72 @@ ADMIN_CALLBACK = getattr(settings, 'TCC_ADMIN_CALLBACK', None)
   # comment related
 COMMENT_MAX_LENGTH = getattr(settings,'COMMENT_MAX_LENGTH',3000)
 MODERATED = getattr(settings, 'TCC_MODERATE', False)
+  # form timestamps are rounded down to this many seconds, which makes the
+  # rendered (hidden) form fields cacheable for that long
+FORM_TIMESTAMP_BUCKET = getattr(settings, 'TCC_FORM_TIMESTAMP_BUCKET', 300)
 CONTENT_TYPES = getattr(settings, 'TCC_CONTENT_TYPES', [])
+  # spam checking (see tcc.spam)
+AKISMET_URL = getattr(settings, 'TCC_AKISMET_URL',
+    'https://rest.akismet.com/1.1/')
+AKISMET_CONCURRENCY = getattr(settings, 'TCC_AKISMET_CONCURRENCY', 8)
+  # per call timeout (seconds) and circuit breaker
+AKISMET_TIMEOUT = getattr(settings, 'TCC_AKISMET_TIMEOUT', 2)
+AKISMET_BREAKER_THRESHOLD = getattr(settings,
+    'TCC_AKISMET_BREAKER_THRESHOLD', 5)
+AKISMET_BREAKER_RESET = getattr(settings, 'TCC_AKISMET_BREAKER_RESET', 60)
+  # in-process cache of verdicts for repeated content (0 disables it)
+SPAM_CACHE_SIZE = getattr(settings, 'TCC_SPAM_CACHE_SIZE', 10000)
+SPAM_CACHE_TTL = getattr(settings, 'TCC_SPAM_CACHE_TTL', 60 * 60)
+  # akismet_data() keys which are part of the cache key next to the content
+  # and the user
+SPAM_CACHE_SIGNALS = getattr(settings, 'TCC_SPAM_CACHE_SIGNALS',
+    ('comment_author_email', 'comment_author_url'))
+  # local pre-filter (see tcc.classifier), None disables it
+SPAM_CLASSIFIER = getattr(settings, 'TCC_SPAM_CLASSIFIER', None)
+  # spam probabilities below / above these are trusted without Akismet
+SPAM_CLASSIFIER_HAM = getattr(settings, 'TCC_SPAM_CLASSIFIER_HAM', 0.01)
+SPAM_CLASSIFIER_SPAM = getattr(settings, 'TCC_SPAM_CLASSIFIER_SPAM', 0.99)
+SPAM_CHECK_ON_POST = getattr(settings, 'TCC_SPAM_CHECK_ON_POST', False)
+SPAM_CHECK_BACKEND = getattr(settings, 'TCC_SPAM_CHECK_BACKEND',
+    'tcc.spam.ImmediateBackend')
+SPAM_CHECK_BATCH_SIZE = getattr(settings, 'TCC_SPAM_CHECK_BATCH_SIZE', 50)
+SPAM_CHECK_INTERVAL = getattr(settings, 'TCC_SPAM_CHECK_INTERVAL', 2)
 SUBSCRIBE_ON_POST = True
+  # send periodic digests (tcc_send_digests) instead of a mail per comment
+NOTIFICATION_DIGEST = getattr(settings, 'TCC_NOTIFICATION_DIGEST', False)
+  # comments older than this (in days) are never included in a digest
+NOTIFICATION_DIGEST_MAX_AGE = getattr(settings,
+    'TCC_NOTIFICATION_DIGEST_MAX_AGE', 7)
+  # deliver comment_was_posted/comment_was_flagged after the request
+  # committed, from background threads (see tcc.dispatch)
+DEFERRED_SIGNALS = getattr(settings, 'TCC_DEFERRED_SIGNALS', False)
+DEFERRED_SIGNAL_WORKERS = getattr(settings, 'TCC_DEFERRED_SIGNAL_WORKERS', 2)
+DEFERRED_SIGNAL_BATCH_SIZE = getattr(settings,
+    'TCC_DEFERRED_SIGNAL_BATCH_SIZE', 100)
+DEFERRED_SIGNAL_INTERVAL = getattr(settings,
+    'TCC_DEFERRED_SIGNAL_INTERVAL', 0.5)
+  # write CommentEvent rows along with every change (see tcc.events)
+EVENT_OUTBOX = getattr(settings, 'TCC_EVENT_OUTBOX', False)
+  # {consumer name: 'path.to.callable'}, called with lists of events
+EVENT_CONSUMERS = getattr(settings, 'TCC_EVENT_CONSUMERS', {})
+  # seconds before an event is handed to the consumers, the longest a
+  # transaction writing events may take to commit
+EVENT_SETTLE_TIME = getattr(settings, 'TCC_EVENT_SETTLE_TIME', 30)
+  # buffer read markers in the cache, flushed by tcc_flush_read_markers
+READ_MARKER_BUFFER = getattr(settings, 'TCC_READ_MARKER_BUFFER', False)
+  # how long (in seconds) buffered markers are kept, must be (well) above
+  # the flush interval
+READ_MARKER_TTL = getattr(settings, 'TCC_READ_MARKER_TTL', 24 * 3600)
+  # buffered markers kept per user, beyond that they're written back at once
+READ_MARKER_MAX = getattr(settings, 'TCC_READ_MARKER_MAX', 200)
+  # {'user': [(count, seconds), ...], 'ip': [...]}, see tcc.ratelimit
+RATE_LIMITS = getattr(settings, 'TCC_RATE_LIMITS', {})
+  # append replies to ReplyDelta instead of updating the parent's
+  # child_count / sort_date right away, needs a cache shared by all processes
+COALESCE_REPLIES = getattr(settings, 'TCC_COALESCE_REPLIES', False)
 SORT_BY_LATEST_COMMENT = getattr(settings, 'TCC_SORT_BY_LATEST_COMMENT', False)
+  # bump this whenever the comment_will_be_posted receivers change their output
+PARSER_VERSION = getattr(settings, 'TCC_PARSER_VERSION', 1)
 
   # Wow ... weirdness occurs without the following monkeypatch for python2.6
   #
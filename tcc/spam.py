@@ -0,0 +1,579 @@
+'''
+Spam checking with Akismet, off the request path.
+
+Posting only enqueues the comment id (see TCC_SPAM_CHECK_ON_POST). A backend
+(TCC_SPAM_CHECK_BACKEND) hands the ids to `check_comments` which asks
+Akismet about the comments concurrently and writes the verdicts back in bulk.
+
+Every Akismet call has a timeout (TCC_AKISMET_TIMEOUT) and goes through a
+circuit breaker. While the breaker is open calls fail right away with
+AkismetUnavailable and the comments stay unchecked (spam_status NULL) to be
+checked again later.
+
+Verdicts are cached by content fingerprint and author, so spammers posting
+(nearly) the same content over and over are classified without asking
+Akismet. The optional local classifier (tcc.classifier) handles the comments
+it is confident about, only the others are sent to Akismet.
+'''
+import httplib
+import logging
+import Queue
+import re
+import socket
+import threading
+import time
+import urllib
+import urlparse
+from collections import OrderedDict
+from hashlib import sha1
+from multiprocessing.pool import ThreadPool
+
+from django.conf import settings
+from django.core.urlresolvers import get_callable
+from django.db import connection
+from django.template.defaultfilters import striptags
+from django.utils.encoding import smart_str
+
+from entity.static import SPAM_STATUS_CHOICES
+
+from tcc import classifier
+from tcc.models import Comment, CommentEvent, Subscription
+from tcc import settings as tcc_settings
+from tcc.utils import LatencyStats, atomic
+
+logger = logging.getLogger(__name__)
+
+SPAM = SPAM_STATUS_CHOICES.dict.get('Spam')
+HAM = SPAM_STATUS_CHOICES.dict.get('Ham')
+
+_NOISE = re.compile(r'[\W\d_]+', re.UNICODE)
+
+_client = None
+_pool = None
+_lock = threading.Lock()
+_backend = None
+
+
+class AkismetError(Exception):
+    pass
+
+
+class AkismetUnavailable(AkismetError):
+    ''' Raised while the circuit breaker is open '''
+
+
+class CircuitBreaker(object):
+    '''
+    Opens after `threshold` consecutive failures, after which calls fail
+    right away. Once `reset_timeout` seconds have passed a single trial call
+    is let through (half open): the breaker closes again if it succeeds and
+    re-opens if it fails.
+    '''
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, threshold=tcc_settings.AKISMET_BREAKER_THRESHOLD,
+                 reset_timeout=tcc_settings.AKISMET_BREAKER_RESET):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.trips = 0
+        self.opened_at = None
+        self._trial = False
+        self._lock = threading.Lock()
+
+    def _get_state(self):
+        if self.opened_at is None:
+            return self.CLOSED
+        if time.time() - self.opened_at >= self.reset_timeout:
+            return self.HALF_OPEN
+        return self.OPEN
+    state = property(_get_state)
+
+    def before_call(self):
+        with self._lock:
+            state = self.state
+            if state == self.OPEN or (state == self.HALF_OPEN and self._trial):
+                raise AkismetUnavailable('Akismet circuit breaker is open')
+            if state == self.HALF_OPEN:
+                self._trial = True
+
+    def success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self._trial = False
+
+    def failure(self):
+        with self._lock:
+            self.failures += 1
+            if self._trial or (self.opened_at is None
+                               and self.failures >= self.threshold):
+                self.opened_at = time.time()
+                self.trips += 1
+            self._trial = False
+
+    def as_dict(self):
+        with self._lock:
+            retry_in = None
+            if self.opened_at is not None:
+                retry_in = max(0, self.opened_at + self.reset_timeout
+                               - time.time())
+            return {
+                'state': self.state,
+                'consecutive_failures': self.failures,
+                'trips': self.trips,
+                'opened_at': self.opened_at,
+                'retry_in': retry_in,
+            }
+
+
+class RateLimiter(object):
+    ''' Spaces calls (from any number of threads) to at most `rate` per
+    second '''
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate
+        self._next = time.time()
+        self._lock = threading.Lock()
+
+    def wait(self):
+        with self._lock:
+            now = time.time()
+            wait = self._next - now
+            self._next = max(now, self._next) + self.interval
+        if wait > 0:
+            time.sleep(wait)
+
+
+class VerdictCache(object):
+    ''' Thread safe LRU cache of verdicts which expire after `ttl` seconds '''
+
+    def __init__(self, size=tcc_settings.SPAM_CACHE_SIZE,
+                 ttl=tcc_settings.SPAM_CACHE_TTL):
+        self.size = size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        ''' Returns the cached verdict or None '''
+        with self._lock:
+            item = self._items.pop(key, None)
+            if item is not None and item[1] > time.time():
+  # (re)insert as most recently used
+                self._items[key] = item
+                self.hits += 1
+                return item[0]
+            self.misses += 1
+            return None
+
+    def set(self, key, verdict):
+        if not self.size:
+            return
+        with self._lock:
+            self._items.pop(key, None)
+            self._items[key] = (verdict, time.time() + self.ttl)
+            while len(self._items) > self.size:
+                self._items.popitem(last=False)
+
+    def as_dict(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self._items),
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': lookups and float(self.hits) / lookups or 0.0,
+            }
+
+
+verdict_cache = VerdictCache()
+
+
+class AkismetClient(object):
+    '''
+    Akismet client which keeps a (keep-alive) HTTP connection per thread.
+
+    Has the same interface as the `akismet` module's Akismet class, the API
+    key is sent along with every call so `url` can point to any server.
+    '''
+
+    def __init__(self, key, blog, url=tcc_settings.AKISMET_URL,
+                 agent='tcc', timeout=tcc_settings.AKISMET_TIMEOUT,
+                 breaker=None):
+        self.key = key
+        self.blog = blog
+        self.agent = agent
+        self.timeout = timeout
+        url = urlparse.urlsplit(url)
+        self.scheme = url.scheme
+        self.host = url.netloc
+        self.path = url.path.rstrip('/')
+        self.stats = LatencyStats()
+        self.breaker = breaker or CircuitBreaker()
+        self._local = threading.local()
+
+    def _get_connection(self):
+        conn = getattr(self._local, 'connection', None)
+        if conn is None:
+            if self.scheme == 'https':
+                conn = httplib.HTTPSConnection(self.host,
+                                               timeout=self.timeout)
+            else:
+                conn = httplib.HTTPConnection(self.host, timeout=self.timeout)
+            self._local.connection = conn
+        return conn
+
+    def _close_connection(self):
+        conn = getattr(self._local, 'connection', None)
+        if conn is not None:
+            conn.close()
+            self._local.connection = None
+
+    def _request(self, path, body):
+        headers = {
+            'Content-Type': 'application/x-www-form-urlencoded',
+            'User-Agent': self.agent,
+        }
+  # A kept alive connection may have been closed by the server in the
+  # mean time, so retry once on a fresh connection
+        for attempt in range(2):
+            conn = self._get_connection()
+            try:
+                conn.request('POST', path, body, headers)
+                response = conn.getresponse()
+                return response.status, response.read()
+            except socket.timeout:
+  # Retrying would only blow the latency budget
+                self._close_connection()
+                raise AkismetError('Akismet timed out')
+            except (httplib.HTTPException, socket.error), e:
+                self._close_connection()
+                if attempt:
+                    raise AkismetError('Unable to reach Akismet: %s' % e)
+
+    def call(self, method, comment, data=None):
+        params = dict(data or {})
+        params.update({
+            'api_key': self.key,
+            'blog': self.blog,
+            'comment_content': comment,
+        })
+        body = urllib.urlencode(dict(
+            (k, smart_str(v)) for k, v in params.items() if v is not None))
+
+        self.breaker.before_call()
+        start = time.time()
+        error = True
+        try:
+            status, result = self._request(
+                '%s/%s' % (self.path, method), body)
+            if status != 200:
+                raise AkismetError('%s returned HTTP %d' % (method, status))
+            error = False
+            return result
+        finally:
+            self.stats.add(method, time.time() - start, error)
+            if error:
+                self.breaker.failure()
+            else:
+                self.breaker.success()
+
+    def comment_check(self, comment, data=None):
+        result = self.call('comment-check', comment, data)
+        if result not in ('true', 'false'):
+            raise AkismetError('comment-check returned %r' % result)
+        return result == 'true'
+
+    def submit_spam(self, comment, data=None):
+        self.call('submit-spam', comment, data)
+
+    def submit_ham(self, comment, data=None):
+        self.call('submit-ham', comment, data)
+
+
+def get_client():
+    ''' The (process wide) Akismet client '''
+    global _client
+    if _client is None:
+        with _lock:
+            if _client is None:
+                _client = AkismetClient(getattr(settings, 'AKISMET_KEY'),
+                                        getattr(settings, 'AKISMET_DOMAIN'))
+    return _client
+
+
+def get_pool():
+    ''' The (process wide) thread pool used to talk to Akismet '''
+    global _pool
+    if _pool is None:
+        with _lock:
+            if _pool is None:
+                _pool = ThreadPool(tcc_settings.AKISMET_CONCURRENCY)
+    return _pool
+
+
+def get_stats():
+    ''' Per Akismet method call counts and latencies (in seconds) and the
+    state of the circuit breaker '''
+    client = get_client()
+    return {
+        'methods': client.stats.as_dict(),
+        'breaker': client.breaker.as_dict(),
+        'verdict_cache': verdict_cache.as_dict(),
+        'classifier': dict(classifier.stats),
+    }
+
+
+def fingerprint(comment):
+    ''' Key for the verdict cache: the content without markup, case, digits,
+    punctuation and whitespace plus the author and its
+    TCC_SPAM_CACHE_SIGNALS, so a verdict never carries over to other users '''
+    text = _NOISE.sub(u' ', striptags(comment.comment_raw).lower()).strip()
+    data = comment.akismet_data()
+    parts = [text, unicode(comment.user_id)] + [
+        data.get(k) or u'' for k in tcc_settings.SPAM_CACHE_SIGNALS]
+    return sha1(smart_str(u'\x00'.join(parts))).hexdigest()
+
+
+def remember_verdicts(comments, is_spam):
+    ''' Stores a (human) verdict for the comments in the verdict cache '''
+    for comment in comments:
+        verdict_cache.set(fingerprint(comment), is_spam)
+
+
+def comment_check(comment, limiter=None):
+    ''' Returns whether `comment` is spam
+
+    Tries the verdict cache and the local classifier before asking Akismet.
+    `limiter` (a RateLimiter) throttles the calls to Akismet.
+    '''
+    key = fingerprint(comment)
+    is_spam = verdict_cache.get(key)
+    if is_spam is None:
+        is_spam = classifier.classify(comment.comment_raw)
+        if is_spam is None:
+            if limiter is not None:
+                limiter.wait()
+            is_spam = bool(get_client().comment_check(comment.comment_raw,
+                                                      comment.akismet_data()))
+        verdict_cache.set(key, is_spam)
+    return is_spam
+
+
+def _check(args):
+    comment, limiter = args
+    try:
+        return comment.id, comment_check(comment, limiter)
+    except AkismetUnavailable:
+        return comment.id, None
+    except Exception:
+        logger.exception('Unable to check comment %d', comment.id)
+        return comment.id, None
+
+
+def check_comments(comment_ids, **kwargs):
+    ''' Checks the given (unchecked) comments concurrently and saves the
+    verdicts
+
+    Returns a dict which maps the comment ids to True (spam), False (ham) or
+    None (not checked, e.g. because Akismet is unavailable; the comment
+    stays unchecked).
+    '''
+    comments = list(Comment.unfiltered.filter(
+        id__in=comment_ids,
+        spam_status__isnull=True,
+    ))
+    return check_comment_list(comments, **kwargs)
+
+
+def check_comment_list(comments, pool=None, limiter=None):
+    ''' Like `check_comments` for already fetched comments, `pool`
+    defaults to the process wide pool '''
+    if not comments:
+        return {}
+
+  # Only the Akismet calls run in the pool, the database is left to the
+  # calling thread
+    pool = pool or get_pool()
+    verdicts = dict(pool.map(_check, [(c, limiter) for c in comments]))
+    save_verdicts(comments, verdicts)
+    return verdicts
+
+
+def _submit(args):
+    method, comment = args
+    try:
+        getattr(get_client(), method)(comment.comment_raw,
+                                      comment.akismet_data())
+    except AkismetUnavailable:
+        logger.warning('Akismet unavailable, dropped %s of comment %s',
+                       method, comment.id)
+    except Exception:
+        logger.exception('Unable to %s comment %s', method, comment.id)
+
+
+def submit_many(method, comments):
+    ''' Reports the comments to Akismet (`method` is either 'submit_spam' or
+    'submit_ham') concurrently. Comments by staff members are skipped. '''
+    comments = [c for c in comments if not c.user.is_staff]
+    get_pool().map(_submit, [(method, c) for c in comments])
+
+
+def save_verdicts(comments, verdicts):
+    ''' Writes the verdicts back with one UPDATE per status and sends the
+    notifications for the ham '''
+    spam_ids = [id for id, is_spam in verdicts.items() if is_spam is True]
+    ham_ids = [id for id, is_spam in verdicts.items() if is_spam is False]
+
+    with atomic():
+        if spam_ids:
+            Comment.unfiltered.filter(id__in=spam_ids).update(
+                spam_status=SPAM, is_removed=True)
+            CommentEvent.objects.record(CommentEvent.SPAM,
+                [c for c in comments if c.id in spam_ids])
+        if ham_ids:
+            Comment.unfiltered.filter(id__in=ham_ids).update(
+                spam_status=HAM, is_removed=False)
+            CommentEvent.objects.record(CommentEvent.HAM,
+                [c for c in comments if c.id in ham_ids])
+        Subscription.objects.sync_visibility(spam_ids + ham_ids)
+
+    for comment in comments:
+        if comment.id in ham_ids:
+            comment.spam_status = HAM
+            comment.is_removed = False
+            comment.send_notifications()
+
+
+class ImmediateBackend(object):
+    ''' Checks the comments right away, in the current thread
+
+    Comments that couldn't be checked are left unchecked.
+    '''
+
+    def enqueue(self, comment_ids):
+        check_comments(comment_ids)
+
+    def defer(self, comment_ids):
+        pass
+
+    def join(self):
+        pass
+
+
+class ThreadedBackend(object):
+    '''
+    Collects the comment ids in-process and checks them in batches (of at
+    most TCC_SPAM_CHECK_BATCH_SIZE, collected for at most
+    TCC_SPAM_CHECK_INTERVAL seconds) from a background thread.
+
+    Ids of comments which aren't found (not committed yet, when queued
+    outside of `tcc.dispatch.after_commit`) are queued again after the
+    interval, up to MISSING_RETRIES times. Comments that couldn't be checked
+    because Akismet was unavailable are retried once the circuit breaker
+    allows it.
+    '''
+    MISSING_RETRIES = 3
+
+    def __init__(self, batch_size=tcc_settings.SPAM_CHECK_BATCH_SIZE,
+                 interval=tcc_settings.SPAM_CHECK_INTERVAL):
+        self.batch_size = batch_size
+        self.interval = interval
+        self.queue = Queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+        self._missing = {}
+
+    def enqueue(self, comment_ids):
+        self._start()
+        for comment_id in comment_ids:
+            self.queue.put(comment_id)
+
+    def defer(self, comment_ids):
+        ''' Enqueues the comments again once the breaker may have closed '''
+        if comment_ids:
+            timer = threading.Timer(tcc_settings.AKISMET_BREAKER_RESET,
+                                    self.enqueue, [comment_ids])
+            timer.daemon = True
+            timer.start()
+
+    def retry_missing(self, comment_ids):
+        ''' Enqueues the comments which weren't found again after the
+        interval, until they were retried MISSING_RETRIES times '''
+        retry = []
+        for comment_id in comment_ids:
+            attempts = self._missing.get(comment_id, 0) + 1
+            if attempts > self.MISSING_RETRIES:
+                self._missing.pop(comment_id, None)
+            else:
+                self._missing[comment_id] = attempts
+                retry.append(comment_id)
+        if retry:
+            timer = threading.Timer(self.interval, self.enqueue, [retry])
+            timer.daemon = True
+            timer.start()
+
+    def join(self):
+        ''' Blocks until all enqueued comments are checked '''
+        self.queue.join()
+
+    def _start(self):
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run,
+                        name='tcc-spam-check')
+                    self._thread.daemon = True
+                    self._thread.start()
+
+    def _get_batch(self):
+        batch = [self.queue.get()]
+        deadline = time.time() + self.interval
+        while len(batch) < self.batch_size:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self.queue.get(timeout=timeout))
+            except Queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._get_batch()
+            try:
+                verdicts = check_comments(batch)
+                self.defer([id for id, is_spam in verdicts.items()
+                            if is_spam is None])
+                for id in verdicts:
+                    self._missing.pop(id, None)
+                self.retry_missing([id for id in batch if id not in verdicts])
+            except Exception:
+                logger.exception('Unable to check comments %r', batch)
+            finally:
+                connection.close()
+                for _ in batch:
+                    self.queue.task_done()
+
+
+def get_backend():
+    global _backend
+    if _backend is None:
+        _backend = get_callable(tcc_settings.SPAM_CHECK_BACKEND)()
+    return _backend
+
+
+def enqueue_check(comment_ids):
+    ''' Queues the comments for a spam check '''
+    get_backend().enqueue(comment_ids)
+
+
+def defer_check(comment_ids):
+    ''' Queues the comments for a spam check at a later time '''
+    get_backend().defer(comment_ids)
@@ -13,7 +13,23 @@
         opts = $.extend({}, $.fn.tcc.defaults, options);
         // iterate and reformat each matched element
         return this.each(function(){
-            init();
+            if(opts.user_url){
+                // shared listing: fetch the per-user bits first
+                $.ajax({
+                    url: opts.user_url,
+                    dataType: 'json',
+                    cache: false,
+                    success: function(data){
+                        opts = $.extend(opts, data);
+                        init();
+                    },
+                    error: function(){
+                        init();
+                    }
+                });
+            } else {
+                init();
+            }
         });
     };
 
@@ -22,7 +38,8 @@
         user_id: null,
         user_name: null,
         staff: false,
-        csrf_token: ''
+        csrf_token: '',
+        user_url: null
     };
 
     // private function for debugging
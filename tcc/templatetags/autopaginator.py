@@ -32,15 +32,32 @@ class ParentCommentPaginator(Paginator):
         try:
   # This too results in a query to the database ...
             top = self.parentcomments[bottom+self.per_page-1].sort_date
-            object_list = self.object_list.filter(sort_date__range=(top, bottomdate))
+            object_list = self._filter_dates(top, bottomdate)
         except IndexError:
-            object_list = self.object_list.filter(sort_date__lte=bottomdate)
+            object_list = self._filter_dates(None, bottomdate)
   # And another (final) call to the database
         return Page(object_list, number, self)
 
+    def _filter_dates(self, top, bottomdate):
+        if isinstance(self.object_list, list):
+            return [c for c in self.object_list
+                    if c.sort_date <= bottomdate
+                    and (top is None or c.sort_date >= top)]
+        if top is None:
+            return self.object_list.filter(sort_date__lte=bottomdate)
+        return self.object_list.filter(sort_date__range=(top, bottomdate))
+
     def _get_count(self):
         "Returns the total number of objects, across all pages."
         if self._count is None:
+            if isinstance(self.object_list, list):
+  # Preloaded comments (see api.get_first_pages_for_objects) only hold
+  # the first page but know the total number of root comments
+                self.parentcomments = [c for c in self.object_list
+                                       if not c.parent_id]
+                self._count = getattr(self.object_list, 'root_count',
+                                      len(self.parentcomments))
+                return self._count
             try:
                 self.parentcomments = self.object_list.filter(parent__isnull=True)
                 self._count = self.parentcomments.count()
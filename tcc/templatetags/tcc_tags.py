@@ -4,7 +4,7 @@ from django.contrib.contenttypes.models import ContentType
 from coffin.template.loader import render_to_string
 
 from tcc import api
-from tcc.forms import CommentForm
+from tcc import settings as tcc_settings
 from tcc.utils import get_content_types
 from tcc.views import _get_comment_form
 
@@ -15,21 +15,35 @@ register = template.Library()
 def get_comments_for_object(context, object, next=None):
     ct = ContentType.objects.get_for_model(object)
     request = context['request']
-    initial = {'content_type': ct.id,
-               'object_pk': object.pk,
-               'next': next,
-               }
-    form = CommentForm(object, initial=initial)
+    form = _get_comment_form(ct.id, object.pk, initial={'next': next})
+    preloaded = context.get('tcc_preloaded') or {}
     thread_id = request.GET.get('cpermalink', None)
     if thread_id:
         comments = api.get_comment_thread(thread_id)
+    elif ((ct.id, object.pk) in preloaded
+          and request.GET.get('cpage', '1') == '1'):
+        comments = preloaded[(ct.id, object.pk)]
     else:
         comments = api.get_comments_limited(ct.id, object.pk)
     if not comments:
         comments = []
-    else:
-        comments = comments.order_by('-sort_date', 'path')
-    context.update({'comments': comments, 'form': form})
+    elif not isinstance(comments, list):
+        comments = comments.order_by('-sort_date', 'id')
+    context.update({'comments': comments, 'form': form,
+                    'tcc_shared': tcc_settings.SHARED_LISTING})
     return render_to_string('tcc/list-comments.html',
                             context_instance=context)
 
+
+@register.simple_tag(takes_context=True)
+def preload_comments_for_objects(context, objects, per_page=20):
+    ''' Fetches the first page of comments for all `objects` in one go
+
+    Use it before the `get_comments_for_object` calls (in the same block)
+    on pages which show comments for several objects. `per_page` should
+    match the one used by list-comments.html.
+    '''
+    context['tcc_preloaded'] = api.get_first_pages_for_objects(
+        objects, per_page)
+    return ''
+
@@ -1,12 +1,34 @@
+import BaseHTTPServer
+from datetime import datetime
+import os
+import SocketServer
+import tempfile
+import threading
 import timeit
+import unittest
+import uuid
 
 from django.contrib.auth.models import User
 from django.contrib.contenttypes.models import ContentType
+from django.core import mail
+from django.core.cache import cache
+from django.core.management import call_command
 from django.test import TestCase
 
 from tcc import api
-from tcc.models import Comment
+from tcc import classifier
+from tcc import dispatch
+from tcc import events
+from tcc import identity
+from tcc import ratelimit
+from tcc import readmarkers
+from tcc import notifications
+from tcc import spam
+from tcc.forms import CommentForm, LazyCommentForm
+from tcc.models import Comment, CommentEvent, ReplyDelta, ReplyNotAllowed
+from tcc.models import Subscription, SubscriptionCounter, ThreadParticipant
 from tcc import settings
+from tcc import signals
 
 
 class API(TestCase):
@@ -194,6 +216,467 @@ class API(TestCase):
         uc = api.get_user_comments(
             self.user2.pk, content_type_id=ct.id, object_pk=pk, site_id=1)
 
+    def test_reparse(self):
+        ct = ContentType.objects.get_for_model(self.user1)
+        pk = self.user1.pk
+        parsed = []
+
+        def parser(sender, comment, **kwargs):
+            parsed.append(comment.id)
+            comment.comment = u'<p>%s</p>' % comment.comment.upper()
+        signals.comment_will_be_posted.connect(parser)
+        try:
+            c = api.post_comment(content_type_id=ct.id, object_pk=pk,
+                                 user_id=pk, comment="Root message",
+                                 ip='127.0.0.1')
+            self.assertEqual(c.parser_version, settings.PARSER_VERSION)
+            self.assertEqual(len(parsed), 1)
+  # displaying never parses
+            self.assertEqual(c.get_parsed_comment(), u'<p>ROOT MESSAGE</p>')
+            self.assertEqual(len(parsed), 1)
+  # outdated comments are re-parsed in bulk
+            Comment.unfiltered.filter(id=c.id).update(
+                comment='stale', parser_version=settings.PARSER_VERSION-1)
+            call_command('tcc_reparse', verbosity=0)
+            c = api.get_comment(c.id)
+  # parsed from the raw text, not the stored output
+            self.assertEqual(c.comment, u'<p>ROOT MESSAGE</p>')
+            self.assertEqual(c.parser_version, settings.PARSER_VERSION)
+        finally:
+            signals.comment_will_be_posted.disconnect(parser)
+
+    def test_participants(self):
+        ct = ContentType.objects.get_for_model(self.user1)
+        pk = self.user1.pk
+        root = api.post_comment(content_type_id=ct.id, object_pk=pk,
+                                user_id=self.user1.pk, comment="Root message",
+                                ip='127.0.0.1')
+        reply = api.post_comment(content_type_id=ct.id, object_pk=pk,
+                                 user_id=self.user2.pk, comment="Reply",
+                                 ip='127.0.0.1', parent_id=root.id)
+        self.assertEqual(sorted(reply.get_subscribers()),
+                         sorted([self.user1.pk, self.user2.pk]))
+        api.unsubscribe(reply.id, self.user2)
+        self.assertEqual(list(root.get_subscribers()), [self.user1.pk])
+  # posting again doesn't undo the unsubscribe
+        api.post_comment(content_type_id=ct.id, object_pk=pk,
+                         user_id=self.user2.pk, comment="Another reply",
+                         ip='127.0.0.1', parent_id=root.id)
+        self.assertEqual(list(root.get_subscribers()), [self.user1.pk])
+        api.subscribe(root.id, self.user2)
+        self.assertEqual(sorted(root.get_subscribers()),
+                         sorted([self.user1.pk, self.user2.pk]))
+  # subscribers that never posted
+        user3 = User.objects.create(username='user3', password='user3')
+        api.subscribe(root.id, user3)
+        user4 = User.objects.create(username='user4', password='user4')
+        Subscription.objects.create(user=user4, comment=root)
+        expected = sorted([self.user1.pk, self.user2.pk, user3.pk, user4.pk])
+        self.assertEqual(sorted(root.get_subscribers()), expected)
+  # the rebuild adds the missing authors and keeps the subscribers
+        ThreadParticipant.objects.filter(user=self.user1).delete()
+        call_command('tcc_rebuild_participants', verbosity=0)
+        self.assertEqual(sorted(root.get_subscribers()), expected)
+  # and drops the unsubscribers
+        root.unsubscribers.add(user4)
+        call_command('tcc_rebuild_participants', verbosity=0)
+        self.assertEqual(sorted(root.get_subscribers()), expected[:3])
+
+    def test_event_outbox(self):
+        settings.EVENT_OUTBOX = True
+        try:
+            ct = ContentType.objects.get_for_model(self.user1)
+            pk = self.user1.pk
+            c = api.post_comment(content_type_id=ct.id, object_pk=pk,
+                                 user_id=pk, comment="Root message",
+                                 ip='127.0.0.1')
+            api.remove_comment(c.id, self.user1)
+            api.restore_comment(c.id, self.user1)
+            Comment.unfiltered.filter(id=c.id).mark_as_spam(
+                send_to_akismet=False)
+  # unchanged comments don't get an event
+            Comment.unfiltered.filter(id=c.id).mark_as_spam(
+                send_to_akismet=False)
+            Comment.unfiltered.get(id=c.id).delete()
+        finally:
+            settings.EVENT_OUTBOX = False
+
+        handled = []
+  # too fresh, their transaction might not have committed yet
+        self.assertEqual(events.consume('test', handled.extend), 0)
+        self.assertEqual(events.consume('test', handled.extend,
+                                        batch_size=2, settle_time=0), 5)
+        self.assertEqual([e.kind for e in handled], [
+            CommentEvent.POSTED, CommentEvent.REMOVED, CommentEvent.RESTORED,
+            CommentEvent.SPAM, CommentEvent.DELETED])
+        self.assertEqual(set(e.comment_id for e in handled), set([c.id]))
+  # the high-water mark moved past them
+        self.assertEqual(events.consume('test', handled.extend,
+                                        settle_time=0), 0)
+
+    def test_unread_count(self):
+        ct = ContentType.objects.get_for_model(self.user1)
+        pk = self.user1.pk
+        root = api.post_comment(content_type_id=ct.id, object_pk=pk,
+                                user_id=self.user1.pk, comment="Root message",
+                                ip='127.0.0.1')
+        Comment.unfiltered.filter(id=root.id).update(spam_status=spam.HAM)
+        root = Comment.unfiltered.get(id=root.id)
+        Subscription.objects.create(user=self.user1, comment=root)
+        subscription = Subscription.objects.create(user=self.user2,
+                                                   comment=root)
+        self.assertEqual(api.get_unread_count(self.user1.pk), 0)
+        self.assertEqual(api.get_unread_count(self.user2.pk), 1)
+        subscription.read_at = datetime.now()
+        subscription.save()
+        self.assertEqual(api.get_unread_count(self.user2.pk), 0)
+  # a reply makes the thread unread for the other subscribers
+        api.post_comment(content_type_id=ct.id, object_pk=pk,
+                         user_id=self.user2.pk, comment="Reply",
+                         ip='127.0.0.1', parent_id=root.id)
+        self.assertEqual(api.get_unread_count(self.user1.pk), 1)
+        self.assertEqual(api.get_unread_count(self.user2.pk), 0)
+        counter = SubscriptionCounter.objects.get(user=self.user1)
+        self.assertEqual(counter.total, 1)
+
+        SubscriptionCounter.objects.all().delete()
+        call_command('tcc_rebuild_inbox', verbosity=0)
+        self.assertEqual(api.get_unread_count(self.user1.pk), 1)
+        self.assertEqual(api.get_unread_count(self.user2.pk), 0)
+
+        subscriptions, cursor = api.get_inbox(self.user1)
+        self.assertEqual([s.comment_id for s in subscriptions], [root.id])
+        self.assertEqual(cursor, None)
+  # removing the thread hides it from the other inboxes
+        api.remove_comment(root.id, self.user1)
+        self.assertEqual(api.get_inbox(self.user2)[0], [])
+        self.assertEqual(len(api.get_inbox(self.user1)[0]), 1)
+        api.restore_comment(root.id, self.user1)
+        self.assertEqual(len(api.get_inbox(self.user2)[0]), 1)
+
+        self.assertEqual(api.mark_thread_read(root.id, self.user1), 1)
+        self.assertEqual(api.get_unread_count(self.user1.pk), 0)
+        self.assertEqual(api.mark_inbox_read(self.user1), 0)
+
+    def test_buffered_read_markers(self):
+        ct = ContentType.objects.get_for_model(self.user1)
+        root = api.post_comment(content_type_id=ct.id, object_pk=self.user1.pk,
+                                user_id=self.user1.pk, comment="Root message",
+                                ip='127.0.0.1')
+        Comment.unfiltered.filter(id=root.id).mark_as_ham(
+            send_to_akismet=False)
+        Subscription.objects.create(user=self.user2, comment=root)
+        self.assertEqual(api.get_unread_count(self.user2.pk), 1)
+
+        settings.READ_MARKER_BUFFER = True
+        try:
+            self.assertEqual(api.mark_thread_read(root.id, self.user2), None)
+            subscription = Subscription.objects.get(user=self.user2)
+            self.assertTrue(subscription.unread)
+  # the user sees the buffered state right away
+            self.assertEqual(api.get_unread_count(self.user2.pk), 0)
+            self.assertTrue(api.get_inbox(self.user2)[0][0].read)
+
+            self.assertEqual(readmarkers.flush(), 1)
+            subscription = Subscription.objects.get(user=self.user2)
+            self.assertTrue(subscription.read)
+            self.assertEqual(api.get_unread_count(self.user2.pk), 0)
+            self.assertEqual(readmarkers.flush(), 0)
+
+  # flushed markers are dropped from the cache
+            self.assertEqual(readmarkers.get_overlay(self.user2.pk), {})
+
+  # beyond READ_MARKER_MAX they're written back right away
+            other = api.post_comment(content_type_id=ct.id,
+                                     object_pk=self.user1.pk,
+                                     user_id=self.user1.pk,
+                                     comment="Other message", ip='127.0.0.1')
+            Subscription.objects.create(user=self.user2, comment=other)
+            api.mark_thread_read(other.id, self.user2)
+            self.assertEqual(readmarkers.get_overlay(self.user2.pk).keys(),
+                             [other.id])
+            read_marker_max = settings.READ_MARKER_MAX
+            settings.READ_MARKER_MAX = 1
+            try:
+                api.mark_thread_read(root.id, self.user2)
+            finally:
+                settings.READ_MARKER_MAX = read_marker_max
+            self.assertEqual(readmarkers.get_overlay(self.user2.pk), {})
+            self.assertTrue(Subscription.objects.get(user=self.user2,
+                                                     comment=other).read)
+            self.assertEqual(readmarkers.flush(), 0)
+        finally:
+            settings.READ_MARKER_BUFFER = False
+
+    def test_inbox_pages(self):
+        ct = ContentType.objects.get_for_model(self.user1)
+        pk = self.user1.pk
+        roots = []
+        for i in range(5):
+            c = api.post_comment(content_type_id=ct.id, object_pk=pk,
+                                 user_id=self.user1.pk, comment="Thread %d" % i,
+                                 ip='127.0.0.1')
+            Subscription.objects.create(user=self.user2, comment=c)
+            roots.append(c)
+        Comment.unfiltered.filter(id__in=[c.id for c in roots]).mark_as_ham(
+            send_to_akismet=False)
+  # a reply moves the first thread to the top
+        api.post_comment(content_type_id=ct.id, object_pk=pk,
+                         user_id=self.user1.pk, comment="Reply",
+                         ip='127.0.0.1', parent_id=roots[0].id)
+
+        pages = []
+        cursor = None
+        while True:
+            subscriptions, cursor = api.get_inbox(self.user2, cursor,
+                                                  per_page=2)
+            pages.append([s.comment_id for s in subscriptions])
+            if cursor is None:
+                break
+        self.assertEqual(pages, [[roots[0].id, roots[4].id],
+                                 [roots[3].id, roots[2].id],
+                                 [roots[1].id]])
+        self.assertEqual(api.get_unread_count(self.user2.pk), 5)
+
+    def test_conversations(self):
+        ct = ContentType.objects.get_for_model(self.user1)
+        pk = self.user1.pk
+        threads = []
+        for i in range(3):
+            c = api.post_comment(content_type_id=ct.id, object_pk=pk,
+                                 user_id=self.user1.pk, comment="Message %d" % i,
+                                 ip='127.0.0.1')
+            Subscription.objects.create(user=self.user2, comment=c)
+            threads.append(c)
+        Comment.unfiltered.filter(id__in=[c.id for c in threads]).mark_as_ham(
+            send_to_akismet=False)
+        for i in range(2):
+            reply = api.post_comment(content_type_id=ct.id, object_pk=pk,
+                                     user_id=self.user2.pk,
+                                     comment="Answer %d" % i, ip='127.0.0.1',
+                                     parent_id=threads[1].id)
+        api.mark_thread_read(threads[2].id, self.user2)
+
+        with self.assertNumQueries(2):
+            subscriptions, cursor = api.get_conversations(
+                self.user2, per_page=2, content_type_id=ct.id)
+        self.assertEqual([s.comment_id for s in subscriptions],
+                         [threads[1].id, threads[2].id])
+        self.assertEqual(subscriptions[0].last_message.id, reply.id)
+        self.assertEqual(subscriptions[1].last_message.id, threads[2].id)
+        self.assertEqual([s.unread for s in subscriptions], [True, False])
+
+  # an unchecked reply by someone else isn't shown yet
+        api.post_comment(content_type_id=ct.id, object_pk=pk,
+                         user_id=self.user1.pk, comment="Unchecked",
+                         ip='127.0.0.1', parent_id=threads[1].id)
+        with self.assertNumQueries(4):
+            subscriptions, cursor = api.get_conversations(
+                self.user2, per_page=2, content_type_id=ct.id)
+        self.assertEqual(subscriptions[0].last_message.id, reply.id)
+
+        subscriptions, cursor = api.get_conversations(
+            self.user2, cursor, per_page=2, content_type_id=ct.id)
+        self.assertEqual([s.comment_id for s in subscriptions],
+                         [threads[0].id])
+        self.assertEqual(cursor, None)
+  # 'user.profile' isn't configured here, that's no private threads at all
+        self.assertEqual(api.get_conversations(self.user2), ([], None))
+
+    def test_rate_limit(self):
+        settings.RATE_LIMITS = {'user': [(2, 60)], 'ip': [(3, 60)]}
+        try:
+            ip = 'rate-limit-%s' % uuid.uuid4()
+            self.assertTrue(ratelimit.allow(self.user1.pk, ip))
+            self.assertTrue(ratelimit.allow(self.user1.pk, ip))
+            self.assertFalse(ratelimit.allow(self.user1.pk, ip))
+            self.assertTrue(ratelimit.hit('user', self.user2.pk, [(5, 60)]))
+  # the ip is over its limit for every user
+            self.assertFalse(ratelimit.allow(self.user2.pk, ip))
+
+            ct = ContentType.objects.get_for_model(self.user1)
+            form = CommentForm(data={'user': self.user1.pk,
+                                     'content_type': ct.id,
+                                     'object_pk': self.user1.pk}, ip=ip)
+  # rejected before any validation touches the database
+            self.assertNumQueries(0, lambda: form.errors)
+            self.assertFalse(form.is_valid())
+            self.assertTrue(form.non_field_errors())
+        finally:
+            settings.RATE_LIMITS = {}
+
+    def test_user_activity(self):
+        ct = ContentType.objects.get_for_model(self.user1)
+        posted = [api.post_comment(content_type_id=ct.id,
+                                   object_pk=user.pk, user_id=self.user1.pk,
+                                   comment="Comment %d" % i, ip='127.0.0.1')
+                  for i, user in enumerate([self.user1, self.user2] * 2)]
+        api.post_comment(content_type_id=ct.id, object_pk=self.user1.pk,
+                         user_id=self.user2.pk, comment="Someone else",
+                         ip='127.0.0.1')
+
+        pages = []
+        cursor = None
+        while True:
+            comments, cursor = api.get_user_activity(self.user1.pk, cursor,
+                                                     per_page=3)
+  # the commented objects are prefetched
+            self.assertNumQueries(0,
+                lambda: [c.content_object for c in comments])
+            pages.append(comments)
+            if cursor is None:
+                break
+        self.assertEqual([len(p) for p in pages], [3, 1])
+        comments = pages[0] + pages[1]
+        self.assertEqual([c.id for c in comments],
+                         [c.id for c in reversed(posted)])
+        self.assertEqual([c.content_object for c in comments],
+                         [self.user2, self.user1] * 2)
+
+    def test_identity_map(self):
+        ct = ContentType.objects.get_for_model(self.user1)
+        root = api.post_comment(content_type_id=ct.id, object_pk=self.user1.pk,
+                                user_id=self.user1.pk, comment="Root message",
+                                ip='127.0.0.1')
+        reply = api.post_reply(root.id, self.user2.pk, "Reply", '127.0.0.1')
+        hits = identity.get_stats()['hits']
+        with identity.scope() as identity_map:
+            c = api.get_comment(root.id)
+            self.assertTrue(api.get_comment(root.id) is c)
+            self.assertTrue(
+                Comment.unfiltered.get(id=reply.id).parent is c)
+            api.post_reply(root.id, self.user2.pk, "Another", '127.0.0.1')
+  # the UPDATE of the parent is applied to the mapped instance
+            self.assertEqual(c.child_count, 2)
+            self.assertEqual(identity_map.misses, 1)
+  # UPDATEs that can't be applied drop the parent from the map
+            Comment.unfiltered.get(id=reply.id).delete()
+            self.assertEqual(api.get_comment(root.id).child_count, 1)
+        self.assertTrue(identity.get_stats()['hits'] >= hits + 3)
+        self.assertFalse(identity.active())
+
+    def test_reply_limits(self):
+        ct = ContentType.objects.get_for_model(self.user1)
+        pk = self.user1.pk
+        root = api.post_comment(content_type_id=ct.id, object_pk=pk,
+                                user_id=self.user1.pk, comment="Root message",
+                                ip='127.0.0.1')
+        stale = Comment.unfiltered.get(id=root.id)
+        max_replies = Comment.MAX_REPLIES
+        Comment.MAX_REPLIES = 2
+        try:
+            for i in range(2):
+                self.assertTrue(api.post_reply(root.id, self.user2.pk,
+                                               "Reply %d" % i, '127.0.0.1'))
+  # the limit holds for a stale copy of the parent as well
+            self.assertEqual(stale.child_count, 0)
+            reply = Comment(content_type_id=ct.id, object_pk=pk,
+                            user_id=self.user2.pk, comment="Too many",
+                            ip_address='127.0.0.1', parent=stale)
+            self.assertRaises(ReplyNotAllowed, reply.save)
+            self.assertEqual(
+                Comment.unfiltered.get(id=root.id).child_count, 2)
+        finally:
+            Comment.MAX_REPLIES = max_replies
+
+        api.close_comment(root.id, self.user1)
+        self.assertEqual(api.post_reply(root.id, self.user2.pk, "Closed",
+                                        '127.0.0.1'), None)
+  # replies to replies are too deep
+        reply = Comment.unfiltered.filter(parent=root.id)[0]
+        self.assertEqual(api.post_reply(reply.id, self.user1.pk, "Deep",
+                                        '127.0.0.1'), None)
+        max_depth = settings.MAX_DEPTH
+        settings.MAX_DEPTH = 3
+        try:
+            deep = api.post_reply(reply.id, self.user1.pk, "Deep",
+                                  '127.0.0.1')
+            self.assertTrue(deep)
+            self.assertEqual(api.post_reply(deep.id, self.user2.pk,
+                                            "Too deep", '127.0.0.1'), None)
+        finally:
+            settings.MAX_DEPTH = max_depth
+
+    def test_coalesced_replies(self):
+        cache.clear()
+        ct = ContentType.objects.get_for_model(self.user1)
+        pk = self.user1.pk
+        root = api.post_comment(content_type_id=ct.id, object_pk=pk,
+                                user_id=self.user1.pk, comment="Root message",
+                                ip='127.0.0.1')
+        settings.COALESCE_REPLIES = True
+        max_replies = Comment.MAX_REPLIES
+        Comment.MAX_REPLIES = 3
+        try:
+            replies = [api.post_comment(content_type_id=ct.id, object_pk=pk,
+                                        user_id=self.user2.pk,
+                                        comment="Reply %d" % i,
+                                        ip='127.0.0.1', parent_id=root.id)
+                       for i in range(2)]
+  # evicted from the cache (reseeded from the replies), then an index is
+  # burned by a failed insert and taken back at the limit
+            cache.delete(ReplyDelta.objects.INDEX_KEY % root.id)
+            self.assertEqual(ReplyDelta.objects.next_index(root.id), 3)
+            replies.append(api.post_comment(content_type_id=ct.id,
+                object_pk=pk, user_id=self.user2.pk, comment="Reply 2",
+                ip='127.0.0.1', parent_id=root.id))
+            self.assertEqual([r.index for r in replies], [1, 2, 3])
+  # the parent isn't touched until the deltas are folded
+            stale = Comment.unfiltered.get(id=root.id)
+            self.assertEqual(stale.child_count, 0)
+            self.assertEqual(stale.get_child_count(), 3)
+            self.assertFalse(stale.reply_allowed())
+            self.assertEqual(ReplyDelta.objects.count(), 3)
+            self.assertEqual(api.post_comment(content_type_id=ct.id,
+                object_pk=pk, user_id=self.user2.pk, comment="One too many",
+                ip='127.0.0.1', parent_id=root.id), None)
+
+
+  # listings select the pending counts along with the comments, reads
+  # don't fold
+            with self.assertNumQueries(1):
+                counts = dict((c.id, c.get_child_count()) for c in
+                              api.get_comments_limited(ct.id, pk))
+            self.assertEqual(counts[root.id], 3)
+            self.assertEqual(counts[replies[0].id], 0)
+            self.assertEqual(ReplyDelta.objects.count(), 3)
+
+            call_command('tcc_fold_replies', verbosity=0)
+            root = Comment.unfiltered.get(id=root.id)
+            self.assertEqual(root.child_count, 3)
+            self.assertEqual(root.sort_date, replies[-1].submit_date)
+            self.assertEqual(ReplyDelta.objects.count(), 0)
+            self.assertEqual(api.get_comment_thread(root.id)[0]
+                             .get_child_count(), 0)
+        finally:
+            settings.COALESCE_REPLIES = False
+            Comment.MAX_REPLIES = max_replies
+
+    def test_first_pages_for_objects(self):
+        ct = ContentType.objects.get_for_model(self.user1)
+        for user in (self.user1, self.user2):
+            for _ in range(3):
+                p = api.post_comment(content_type_id=ct.id, object_pk=user.pk,
+                                     user_id=self.user1.pk,
+                                     comment="Root message %s" % _,
+                                     ip='127.0.0.1')
+                api.post_reply(user_id=self.user1.pk, comment="Reply %s" % _,
+                               parent_id=p.id)
+  # both objects have more than a page of roots
+        with self.assertNumQueries(4):
+            preloaded = api.get_first_pages_for_objects(
+                [self.user1, self.user2], per_page=2)
+        for user in (self.user1, self.user2):
+            comments = preloaded[(ct.id, user.pk)]
+            self.assertEqual(comments.root_count, 3)
+            roots = [c for c in comments if not c.parent_id]
+            self.assertEqual(len(roots), 2)
+            self.assertTrue(all(c.object_pk == user.pk for c in comments))
+  # the same order as the listing
+            self.assertEqual([c.id for c in comments], [c.id for c in
+                api.get_comments_limited(ct.id, user.pk).order_by(
+                    '-sort_date', 'id')[:len(comments)]])
+
     def test_tree_depth(self):
         ct = ContentType.objects.get_for_model(self.user1)
         pk = self.user1.pk
@@ -250,3 +733,462 @@ class ORM(TestCase):
                 c = api.post_reply(user_id=pk, comment="Reply %s%s" % (_, __), parent_id=p.id)
         self.assertEqual(api.get_comments_limited(ct.id, pk).count(), 5*(settings.REPLY_LIMIT+1))
 
+
+    def test_chunked(self):
+        ct = ContentType.objects.get_for_model(self.user1)
+        pk = self.user1.pk
+        for _ in range(5):
+            p = api.post_comment(content_type_id=ct.id, object_pk=pk,
+                                 user_id=pk, comment="Root message %s" % _,
+                                 ip='127.0.0.1')
+            api.post_reply(user_id=pk, comment="Reply %s" % _, parent_id=p.id)
+        comments = api.get_comments(ct.id, pk).order_by('-sort_date')
+        chunked = comments.chunked(3)
+        self.assertEqual(len(chunked), 10)
+        self.assertTrue(chunked)
+        self.assertEqual([c.id for c in chunked], [c.id for c in comments])
+  # filtering (as the paginator does) keeps the chunking
+        roots = chunked.filter(parent__isnull=True)
+        self.assertEqual(roots.chunk_size, 3)
+        self.assertEqual(len(list(roots)), 5)
+        self.assertFalse(chunked.filter(id=-1))
+  # a comment posted while streaming doesn't shift the chunks
+        expected = [c.id for c in comments]
+        streamed = []
+        for c in comments.chunked(3):
+            streamed.append(c.id)
+            if len(streamed) == 3:
+                api.post_comment(content_type_id=ct.id, object_pk=pk,
+                                 user_id=pk, comment="While streaming",
+                                 ip='127.0.0.1')
+        self.assertEqual(streamed, expected)
+
+
+class FakeAkismetHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        self.server.requests.append((self.path, body))
+        if self.path.endswith('comment-check'):
+            result = 'viagra' in body and 'true' or 'false'
+        else:
+            result = 'Thanks for making the web a better place.'
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(result)))
+        self.end_headers()
+        self.wfile.write(result)
+
+    def log_message(self, *args):
+        pass
+
+
+class FakeAkismetServer(SocketServer.ThreadingMixIn,
+                        BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    request_queue_size = 64
+
+    def __init__(self):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0),
+                                           FakeAkismetHandler)
+        self.requests = []
+        self.url = 'http://127.0.0.1:%d/1.1/' % self.server_address[1]
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+
+class FakeAkismet(object):
+    calls = 0
+
+    def comment_check(self, comment, data=None):
+        FakeAkismet.calls += 1
+        return 'viagra' in comment
+
+    def submit_spam(self, comment, data=None):
+        pass
+
+    def submit_ham(self, comment, data=None):
+        pass
+
+
+class Spam(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create(username='user1', password='user1')
+        self.ct = ContentType.objects.get_for_model(self.user)
+        self.notified = []
+        self._get_client = spam.get_client
+        self._send_notifications = Comment.send_notifications
+        self._verdict_cache = spam.verdict_cache
+        spam.get_client = FakeAkismet
+        spam.verdict_cache = spam.VerdictCache()
+        Comment.send_notifications = \
+            lambda comment: self.notified.append(comment.id)
+
+    def tearDown(self):
+        spam.get_client = self._get_client
+        spam.verdict_cache = self._verdict_cache
+        Comment.send_notifications = self._send_notifications
+        self.user.delete()
+
+    def _post(self, comment):
+        return api.post_comment(content_type_id=self.ct.id,
+                                object_pk=self.user.pk, user_id=self.user.pk,
+                                comment=comment, ip='127.0.0.1')
+
+    def test_check_comments(self):
+        ham = self._post('Nice shoes')
+        spammy = self._post('Cheap viagra')
+        verdicts = spam.check_comments([ham.id, spammy.id])
+        self.assertEqual(verdicts, {ham.id: False, spammy.id: True})
+        ham = Comment.unfiltered.get(id=ham.id)
+        spammy = Comment.unfiltered.get(id=spammy.id)
+        self.assertEqual(ham.spam_status, spam.HAM)
+        self.assertFalse(ham.is_removed)
+        self.assertEqual(spammy.spam_status, spam.SPAM)
+        self.assertTrue(spammy.is_removed)
+        self.assertEqual(self.notified, [ham.id])
+  # checked comments aren't checked again
+        self.assertEqual(spam.check_comments([ham.id, spammy.id]), {})
+
+    def test_client(self):
+        server = FakeAkismetServer()
+        try:
+            client = spam.AkismetClient('key', 'http://example.com/',
+                                        url=server.url)
+            spam.get_client = lambda: client
+            ham = self._post('Nice shoes')
+            spammy = self._post('Cheap viagra')
+            self.assertFalse(spam.comment_check(ham))
+            self.assertTrue(spam.comment_check(spammy))
+            Comment.unfiltered.filter(id__in=[ham.id, spammy.id]
+                ).mark_as_spam()
+            paths = [path for path, body in server.requests]
+            self.assertEqual(paths.count('/1.1/submit-spam'), 2)
+            self.assertTrue(all('api_key=key' in body
+                                for path, body in server.requests))
+            stats = client.stats.as_dict()
+            self.assertEqual(stats['comment-check']['calls'], 2)
+            self.assertEqual(stats['submit-spam']['errors'], 0)
+        finally:
+            server.shutdown()
+
+    def test_circuit_breaker(self):
+        server = FakeAkismetServer()
+        url = server.url
+        server.shutdown()
+        server.server_close()
+        breaker = spam.CircuitBreaker(threshold=2, reset_timeout=60)
+        client = spam.AkismetClient('key', 'http://example.com/', url=url,
+                                    timeout=0.5, breaker=breaker)
+        spam.get_client = lambda: client
+        c = self._post('Nice shoes')
+        for _ in range(2):
+            self.assertEqual(c.check_comment(), None)
+        self.assertEqual(breaker.state, spam.CircuitBreaker.OPEN)
+  # while open Akismet isn't even tried
+        self.assertRaises(spam.AkismetUnavailable, spam.comment_check, c)
+        self.assertEqual(client.stats.as_dict()['comment-check']['calls'], 2)
+        self.assertEqual(Comment.unfiltered.get(id=c.id).spam_status, None)
+        self.assertEqual(spam.check_comments([c.id]), {c.id: None})
+        self.assertEqual(breaker.as_dict()['trips'], 1)
+  # after the reset timeout a trial call is let through
+        breaker.opened_at -= 60
+        self.assertEqual(breaker.state, spam.CircuitBreaker.HALF_OPEN)
+        spam.get_client = FakeAkismet
+        breaker.before_call()
+        breaker.success()
+        self.assertEqual(breaker.state, spam.CircuitBreaker.CLOSED)
+
+    def test_verdict_cache(self):
+        FakeAkismet.calls = 0
+        first = self._post('Cheap <b>viagra</b> at 50% off!')
+        second = self._post('CHEAP viagra at 75% off')
+        other = self._post('Nice shoes')
+        self.assertTrue(spam.comment_check(first))
+        self.assertTrue(spam.comment_check(second))
+        self.assertEqual(FakeAkismet.calls, 1)
+        self.assertFalse(spam.comment_check(other))
+        self.assertEqual(FakeAkismet.calls, 2)
+        stats = spam.verdict_cache.as_dict()
+        self.assertEqual((stats['hits'], stats['misses']), (1, 2))
+  # human verdicts override the cached ones
+        other.mark_as_spam(send_to_akismet=False)
+        self.assertTrue(spam.comment_check(other))
+        self.assertEqual(FakeAkismet.calls, 2)
+  # but only for the same author
+        user2 = User.objects.create(username='user2', password='user2')
+        same = api.post_comment(content_type_id=self.ct.id,
+                                object_pk=self.user.pk, user_id=user2.pk,
+                                comment='Nice shoes', ip='127.0.0.1')
+        self.assertFalse(spam.comment_check(same))
+        self.assertEqual(FakeAkismet.calls, 3)
+  # size bound and TTL
+        cache = spam.VerdictCache(size=2, ttl=60)
+        for key in 'abc':
+            cache.set(key, True)
+        self.assertEqual(cache.get('a'), None)
+        self.assertEqual(cache.get('c'), True)
+        cache = spam.VerdictCache(size=2, ttl=-1)
+        cache.set('a', True)
+        self.assertEqual(cache.get('a'), None)
+
+    def test_classifier(self):
+        nb = classifier.NaiveBayes(min_examples=2)
+        self.assertEqual(nb.classify('Cheap viagra'), None)
+        for _ in range(20):
+            nb.train('Cheap viagra pills, buy now', True)
+            nb.train('Buy cheap watches now', True)
+            nb.train('Lovely dress, where did you buy it?', False)
+            nb.train('Great outfit, love the shoes', False)
+        self.assertEqual(nb.classify('Buy viagra pills now'), True)
+        self.assertEqual(nb.classify('Love the dress and the shoes'), False)
+        self.assertEqual(nb.classify('Something else entirely'), None)
+
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            nb.prune()
+            nb.save(path)
+            loaded = classifier.NaiveBayes.load(path)
+            self.assertEqual(loaded.tokens, nb.tokens)
+            self.assertEqual(loaded.classify('Buy viagra pills now'), True)
+        finally:
+            os.remove(path)
+
+    def test_recheck_command(self):
+        comments = [self._post('Nice shoes %s' % _) for _ in range(3)]
+        comments.append(self._post('Cheap viagra'))
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            call_command('tcc_recheck', batch_size=2, checkpoint=path,
+                         rate=1000, verbosity=0)
+            self.assertEqual(int(open(path).read()), comments[-1].id)
+        finally:
+            os.remove(path)
+        statuses = dict(Comment.unfiltered.values_list('id', 'spam_status'))
+        self.assertEqual([statuses[c.id] for c in comments],
+                         [spam.HAM, spam.HAM, spam.HAM, spam.SPAM])
+
+    def test_rate_limiter(self):
+        limiter = spam.RateLimiter(100)
+        start = timeit.default_timer()
+        for _ in range(11):
+            limiter.wait()
+        self.assertTrue(timeit.default_timer() - start >= 0.09)
+
+    def test_backend(self):
+        backend = spam.ImmediateBackend()
+        c = self._post('Nice shoes')
+        backend.enqueue([c.id])
+        backend.join()
+        self.assertEqual(Comment.unfiltered.get(id=c.id).spam_status,
+                         spam.HAM)
+
+
+class Notifications(TestCase):
+    usernames = ['user1', 'user2', 'user3']
+
+    def setUp(self):
+        for name in self.usernames:
+            u = User.objects.create(username=name, password=name,
+                                    email='%s@example.com' % name)
+            setattr(self, name, u)
+        self.ct = ContentType.objects.get_for_model(self.user1)
+
+    def tearDown(self):
+        for name in self.usernames:
+            User.objects.get(username=name).delete()
+
+    def _post(self, user, comment, parent=None):
+        c = api.post_comment(content_type_id=self.ct.id,
+                             object_pk=self.user1.pk, user_id=user.pk,
+                             comment=comment, ip='127.0.0.1',
+                             parent_id=parent and parent.id)
+        Comment.unfiltered.filter(id=c.id).update(spam_status=spam.HAM)
+        return c
+
+    def test_send_digests(self):
+        root = self._post(self.user1, 'Root message')
+        self._post(self.user2, 'First reply', root)
+        self._post(self.user2, 'Second reply', root)
+        api.unsubscribe(root.id, self.user3)
+        self._post(self.user3, 'Third reply', root)
+        mail.outbox = []
+        self.assertEqual(notifications.send_digests(), 2)
+  # one mail per subscriber, never for their own comments
+        mails = dict((m.to[0], m.body) for m in mail.outbox)
+        self.assertEqual(sorted(mails), ['user1@example.com',
+                                         'user2@example.com'])
+        self.assertTrue('Second reply' in mails['user1@example.com'])
+        self.assertTrue('Third reply' in mails['user1@example.com'])
+        self.assertFalse('First reply' in mails['user2@example.com'])
+        self.assertFalse(notifications.get_pending().exists())
+  # nothing left to send
+        mail.outbox = []
+        self.assertEqual(notifications.send_digests(), 0)
+        self.assertEqual(mail.outbox, [])
+
+
+class Dispatch(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create(username='user1', password='user1')
+        self.ct = ContentType.objects.get_for_model(self.user)
+        self.received = []
+        signals.comment_was_posted.connect(self._receiver)
+        settings.DEFERRED_SIGNALS = True
+
+    def tearDown(self):
+        settings.DEFERRED_SIGNALS = False
+        signals.comment_was_posted.disconnect(self._receiver)
+        self.user.delete()
+
+    def _receiver(self, sender, comment, **kwargs):
+        self.received.append(comment.id)
+
+    def _post(self, comment):
+        return api.post_comment(content_type_id=self.ct.id,
+                                object_pk=self.user.pk, user_id=self.user.pk,
+                                comment=comment, ip='127.0.0.1')
+
+    def test_deferred(self):
+        with dispatch.deferred():
+            c = self._post('Deferred')
+            self.assertEqual(self.received, [])
+        dispatch.get_dispatcher().join()
+        self.assertEqual(self.received, [c.id])
+  # events of a failed block are dropped
+        try:
+            with dispatch.deferred():
+                self._post('Failed')
+                raise ValueError
+        except ValueError:
+            pass
+        dispatch.get_dispatcher().join()
+        self.assertEqual(self.received, [c.id])
+        self.assertEqual(
+            dispatch.get_stats()['tcc.tests._receiver']['errors'], 0)
+
+    def test_after_commit(self):
+        calls = []
+        with dispatch.deferred():
+            dispatch.after_commit(calls.append, 1)
+            self.assertEqual(calls, [])
+        self.assertEqual(calls, [1])
+        try:
+            with dispatch.deferred():
+                dispatch.after_commit(calls.append, 2)
+                raise ValueError
+        except ValueError:
+            pass
+        self.assertEqual(calls, [1])
+  # outside of a request it's called right away
+        dispatch.after_commit(calls.append, 3)
+        self.assertEqual(calls, [1, 3])
+
+    def test_coalesce(self):
+        c = self._post('Flagged')
+        event = (signals.comment_was_flagged, Comment, {'comment': c})
+        self.assertEqual(dispatch.coalesce([event, event]), [event])
+
+
+@unittest.skipUnless(os.environ.get('TCC_BENCHMARK'),
+                     'set TCC_BENCHMARK=1 to run the benchmarks')
+class Benchmark(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create(username='user1', password='user1')
+        self.ct = ContentType.objects.get_for_model(self.user)
+
+    def tearDown(self):
+        self.user.delete()
+
+    def _report(self, name, func, number=200):
+        seconds = timeit.timeit(func, number=number)
+        print '%s: %.3fms per call' % (name, seconds * 1000 / number)
+
+    def test_bulk_submit(self):
+        server = FakeAkismetServer()
+        get_client = spam.get_client
+        try:
+            client = spam.AkismetClient('key', 'http://example.com/',
+                                        url=server.url)
+            spam.get_client = lambda: client
+            comments = [Comment(user=self.user, comment_raw='spam %d' % i,
+                                ip_address='127.0.0.1') for i in range(1000)]
+            self._report('submit_spam 1000 comments',
+                         lambda: spam.submit_many('submit_spam', comments),
+                         number=1)
+            self.assertEqual(len(server.requests), 1000)
+        finally:
+            spam.get_client = get_client
+            server.shutdown()
+
+    def test_comment_form_render(self):
+        ct_id, pk = self.ct.id, self.user.pk
+        initial = {'content_type': ct_id, 'object_pk': pk}
+
+        form = LazyCommentForm(ct_id, pk)
+        self.assertTrue(form._form is None)
+        self.assertEqual(form.render_fields(),
+                         CommentForm(initial=initial).render_fields())
+
+        def eager():
+            CommentForm(initial=dict(initial)).render_fields()
+
+        def anonymous():
+            # the template never touches the form
+            LazyCommentForm(ct_id, pk)
+
+        def logged_in():
+            LazyCommentForm(ct_id, pk).render_fields()
+
+        self._report('eager CommentForm', eager)
+        self._report('lazy CommentForm (anonymous)', anonymous)
+        self._report('lazy CommentForm (logged in)', logged_in)
+
+    def test_mark_inbox_read(self):
+        n = 10000
+        Comment.unfiltered.bulk_create([
+            Comment(content_type=self.ct, object_pk=self.user.pk, index=i,
+                    user=self.user, comment='Thread %d' % i,
+                    comment_raw='Thread %d' % i, ip_address='127.0.0.1',
+                    spam_status=spam.HAM)
+            for i in range(n)])
+        ids = list(Comment.unfiltered.values_list('id', flat=True))
+        Subscription.objects.bulk_create([
+            Subscription(user=self.user, comment_id=id, visible=True,
+                         sort_date=datetime.now()) for id in ids])
+        self.assertEqual(api.get_unread_count(self.user.pk), n)
+
+        self._report('mark_threads_read 100 of %d' % n,
+                     lambda: api.mark_threads_read(ids[:100], self.user),
+                     number=1)
+        self.assertEqual(api.get_unread_count(self.user.pk), n - 100)
+        self._report('mark_inbox_read %d' % n,
+                     lambda: api.mark_inbox_read(self.user), number=1)
+        self.assertEqual(api.get_unread_count(self.user.pk), 0)
+        self.assertFalse(Subscription.objects.filter(
+            user=self.user, read_at__isnull=True).exists())
+
+        def one_by_one():
+            for subscription in Subscription.objects.filter(user=self.user):
+                subscription.read_at = None
+                subscription.save()
+        self._report('Subscription.save %d' % n, one_by_one, number=1)
+
+    def test_rate_limit(self):
+        limits = {'user': [(10 ** 9, 60), (10 ** 9, 3600)],
+                  'ip': [(10 ** 9, 60)]}
+        rate_limits = settings.RATE_LIMITS
+        settings.RATE_LIMITS = limits
+        try:
+            self._report('ratelimit.allow (3 windows)',
+                         lambda: ratelimit.allow(self.user.pk, '127.0.0.1'),
+                         number=10000)
+        finally:
+            settings.RATE_LIMITS = rate_limits
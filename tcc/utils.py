@@ -1,5 +1,9 @@
+from contextlib import contextmanager
+from datetime import datetime
+import threading
+
 from django.contrib.contenttypes.models import ContentType
-from django.db import models
+from django.db import models, transaction
 from tcc.settings import CONTENT_TYPES
 import operator
 
@@ -39,3 +43,56 @@ def get_content_types_q():
   # simply does (a | b | c) for qs=[a, b, c]
     return reduce(operator.or_, qs[1:], qs[0])
 
+
+@contextmanager
+def atomic():
+    ''' commit_on_success, unless the transaction is already managed (by
+    TransactionMiddleware or an outer block), then it's up to the caller '''
+    if transaction.is_managed():
+        yield
+    else:
+        with transaction.commit_on_success():
+            yield
+
+
+CURSOR_DATE_FORMAT = '%Y%m%d%H%M%S%f'
+
+
+def encode_cursor(date, id):
+    ''' An opaque, url safe position for keyset pagination '''
+    return '%s-%d' % (date.strftime(CURSOR_DATE_FORMAT), id)
+
+
+def decode_cursor(cursor):
+    ''' The (date, id) pair of `encode_cursor`, None if it's invalid '''
+    try:
+        date, id = cursor.split('-')
+        return datetime.strptime(date, CURSOR_DATE_FORMAT), int(id)
+    except (AttributeError, ValueError):
+        return None
+
+
+class LatencyStats(object):
+    ''' Thread safe call counts and latencies, per name (e.g. an Akismet
+    method or a signal receiver) '''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stats = {}
+
+    def add(self, name, seconds, error=False):
+        with self._lock:
+            stats = self._stats.setdefault(name, {
+                'calls': 0, 'errors': 0, 'total': 0.0, 'max': 0.0})
+            stats['calls'] += 1
+            stats['errors'] += int(error)
+            stats['total'] += seconds
+            stats['max'] = max(stats['max'], seconds)
+
+    def as_dict(self):
+        with self._lock:
+            stats = dict((name, dict(values))
+                         for name, values in self._stats.items())
+        for values in stats.values():
+            values['avg'] = values['total'] / values['calls']
+        return stats
@@ -2,18 +2,26 @@ from django.contrib.auth.decorators import login_required
 from django.contrib.contenttypes.models import ContentType
 from django.core.exceptions import ObjectDoesNotExist
 from django.core.urlresolvers import reverse
+from django.forms.forms import NON_FIELD_ERRORS
 from django.http import (HttpResponseBadRequest, HttpResponseRedirect,
-                         HttpResponse, Http404, HttpResponsePermanentRedirect)
+                         HttpResponse, Http404, HttpResponsePermanentRedirect,
+                         StreamingHttpResponse)
+from django.middleware.csrf import get_token
 from django.template import RequestContext
 from django.utils import simplejson
+from django.views.decorators.cache import never_cache
 from django.views.decorators.http import require_POST
 
 from tcc import api, forms
+from tcc import settings as tcc_settings
+from tcc.models import ReplyNotAllowed
 
 from framework.utils import orm, forms as form_utils
 
   # jinja
 from coffin.shortcuts import render_to_response
+from coffin.template import dict_from_django_context
+from coffin.template.loader import get_template
 '''Monkeypatch Django to mimic Jinja2 behaviour'''
 from django.utils import safestring
 
@@ -32,18 +40,47 @@ def _get_comment_form(content_type_id, object_pk, data=None, initial=None):
     if not initial:
         initial = {}
 
+    if data is None:
+        return forms.LazyCommentForm(content_type_id, object_pk, initial)
+
     initial['content_type'] = content_type_id
     initial['object_pk'] = object_pk
     form = forms.CommentForm(data, initial=initial)
     return form
 
 
-def index(request, content_type_id, object_pk):
+def _render_to_response(request, template_name, context, stream=False):
+    ''' render_to_response which optionally streams the template
+
+    When streaming the template is rendered with Jinja's `generate()` while
+    the response is being sent.
+    '''
+    if not stream:
+        return render_to_response(template_name, context)
+  # The template is rendered after the middleware is done with the
+  # response, so make sure the CSRF cookie will be set anyway
+    get_token(request)
+    template = get_template(template_name)
+    return StreamingHttpResponse(
+        template.generate(**dict_from_django_context(context)))
+
+
+def _use_streaming(stream):
+    if stream is None:
+        return tcc_settings.STREAMING
+    return stream
+
+
+def index(request, content_type_id, object_pk, stream=None):
+    stream = _use_streaming(stream)
     comments = api.get_comments_limited(
-        content_type_id, object_pk).order_by('-sort_date', 'path')
+        content_type_id, object_pk).order_by('-sort_date', 'id')
+    if stream:
+        comments = comments.chunked()
     form = _get_comment_form(content_type_id, object_pk)
-    context = RequestContext(request, {'comments': comments, 'form': form })
-    return render_to_response('tcc/index.html', context)
+    context = RequestContext(request, {'comments': comments, 'form': form,
+                                       'tcc_shared': tcc_settings.SHARED_LISTING})
+    return _render_to_response(request, 'tcc/index.html', context, stream)
 
 
 def replies(request, parent_id):
@@ -52,19 +89,39 @@ def replies(request, parent_id):
     return render_to_response('tcc/replies.html', context)
 
 
-def thread(request, thread_id):
+def thread(request, thread_id, stream=None):
   # thead_id here should be the root_id of the thread (even though
   # any comment_id will work) so the entire thread can cached *and*
   # invalidated with one entry
+    stream = _use_streaming(stream)
     comments = api.get_comment_thread(thread_id)
     if not comments:
         raise Http404()
     else:
-        comments = comments.order_by('-sort_date', 'path')
+        comments = comments.order_by('-sort_date', 'id')
+    if stream:
+        comments = comments.chunked()
     rootcomment = comments[0]
     form = _get_comment_form(rootcomment.content_type_id, rootcomment.object_pk)
-    context = RequestContext(request, {'comments': comments, 'form': form})
-    return render_to_response('tcc/index.html', context)
+    context = RequestContext(request, {'comments': comments, 'form': form,
+                                       'tcc_shared': tcc_settings.SHARED_LISTING})
+    return _render_to_response(request, 'tcc/index.html', context, stream)
+
+
+@never_cache
+def user_data(request):
+    ''' The per-user bits (CSRF token, user id, staff flag) for the shared
+    comment listing, see TCC_SHARED_LISTING
+    '''
+    data = {'csrf_token': get_token(request)}
+    user = request.user
+    if user.is_authenticated():
+        data.update({
+            'user_id': user.id,
+            'user_name': user.username,
+            'staff': user.is_staff,
+        })
+    return HttpResponse(simplejson.dumps(data), mimetype='application/json')
 
 
 @login_required
@@ -75,7 +132,11 @@ def post(request):
     data['user'] = request.user.id
     form = forms.CommentForm(data, ip=request.META['REMOTE_ADDR'])
     if form.is_valid():
-        comment = form.save()
+        try:
+            comment = form.save()
+        except ReplyNotAllowed, e:
+            form._errors[NON_FIELD_ERRORS] = form.error_class(e.messages)
+            comment = None
         if comment:
             if request.is_ajax():
                 context = RequestContext(request, {'c': comment})